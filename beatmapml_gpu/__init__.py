@@ -1,7 +1,34 @@
-from .snapshot import make_snapshots
+from .gl_backend import CHANNELS
+from .async_snapshot import iter_snapshots_async, make_snapshots_async
+from .atlas import make_mod_snapshots, make_snapshots_atlas
+from .mods import parse_mods
+from .parameter_convert import calc_audio_capture_rate
+from .snapshot import (estimate_snapshots, make_snapshots,
+                       make_snapshots_at, make_snapshots_multi,
+                       update_snapshots)
+from .storage import SnapshotReader, SnapshotWriter, write_snapshots
+from .windows import (iter_snapshot_windows, make_snapshot_windows,
+                      sliding_windows)
 
 __version__ = '0.2.4'
 
 __all__ = [
-    'make_snapshots'
+    'CHANNELS',
+    'SnapshotReader',
+    'SnapshotWriter',
+    'calc_audio_capture_rate',
+    'estimate_snapshots',
+    'iter_snapshot_windows',
+    'iter_snapshots_async',
+    'make_mod_snapshots',
+    'make_snapshot_windows',
+    'make_snapshots',
+    'make_snapshots_at',
+    'make_snapshots_atlas',
+    'make_snapshots_async',
+    'make_snapshots_multi',
+    'parse_mods',
+    'sliding_windows',
+    'update_snapshots',
+    'write_snapshots'
 ]
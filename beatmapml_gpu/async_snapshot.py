@@ -0,0 +1,168 @@
+from slider import Beatmap
+from numbers import Rational
+from typing import AsyncIterator, Optional, Tuple, Union
+import numpy as np
+import asyncio
+import threading
+
+from .gl_backend import DEFAULT_FRAMES_IN_FLIGHT
+from .snapshot import SnapshotThread
+from .storage import (DEFAULT_CHUNK_FRAMES, DEFAULT_MAX_CHUNKS,
+                      HandoverSink, RenderCancelled)
+
+__all__ = [
+    'iter_snapshots_async',
+    'make_snapshots_async'
+]
+
+
+async def make_snapshots_async(
+        beatmap: Beatmap,
+        target_width: int,
+        capture_rate: Union[int, Rational],
+        device: Optional[int] = None,
+        curve_quality: float = 1.0,
+        multichannel: bool = False,
+        max_tile_size: Optional[int] = None,
+        frames_in_flight: int = DEFAULT_FRAMES_IN_FLIGHT) -> np.ndarray:
+    """Make snapshots of a beatmap without blocking the event loop
+    Args:
+        beatmap (Beatmap): The beatmap to process.
+        target_width (int): The pixel width of desired output.
+        capture_rate (int or Fraction): The capture rate of the snapshots
+            in Hz.
+        device (int): Index of the EGL device to render on. Defaults to
+            the default display.
+        curve_quality (float): Density of slider tessellation relative to
+            the output resolution, see `calc_tolerance`.
+        multichannel (bool): Write separate channels, see `make_snapshots`.
+        max_tile_size (int): Largest framebuffer side in pixels, see
+            `make_snapshots`.
+        frames_in_flight (int): Number of snapshots queued on the GPU
+            before the oldest is read back, see `make_snapshots`.
+    Returns:
+        Snapshots of the beatmap, as returned by `make_snapshots`. The GL
+        work runs on a dedicated render thread owning the context, and
+        errors raised there are raised here.
+    """
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+    result = SnapshotThread.create_buffer(beatmap, target_width,
+                                          capture_rate,
+                                          multichannel=multichannel)
+    processor = SnapshotThread(beatmap, target_width, capture_rate, result,
+                               device=device, curve_quality=curve_quality,
+                               multichannel=multichannel,
+                               max_tile_size=max_tile_size,
+                               frames_in_flight=frames_in_flight)
+
+    def render():
+        try:
+            processor.run()
+        except BaseException as e:
+            post(loop, set_exception, done, e)
+        else:
+            post(loop, set_result, done, result)
+
+    threading.Thread(target=render, daemon=True).start()
+    return await done
+
+
+async def iter_snapshots_async(
+        beatmap: Beatmap,
+        target_width: int,
+        capture_rate: Union[int, Rational],
+        device: Optional[int] = None,
+        curve_quality: float = 1.0,
+        multichannel: bool = False,
+        max_tile_size: Optional[int] = None,
+        frames_in_flight: int = DEFAULT_FRAMES_IN_FLIGHT,
+        chunk_frames: int = DEFAULT_CHUNK_FRAMES,
+        max_chunks: int = DEFAULT_MAX_CHUNKS) \
+        -> AsyncIterator[Tuple[int, np.ndarray]]:
+    """Make snapshots of a beatmap chunk by chunk as they are rendered
+    Args:
+        beatmap (Beatmap): The beatmap to process.
+        target_width (int): The pixel width of desired output.
+        capture_rate (int or Fraction): The capture rate of the snapshots
+            in Hz.
+        device (int): Index of the EGL device to render on. Defaults to
+            the default display.
+        curve_quality (float): Density of slider tessellation relative to
+            the output resolution, see `calc_tolerance`.
+        multichannel (bool): Write separate channels, see `make_snapshots`.
+        max_tile_size (int): Largest framebuffer side in pixels, see
+            `make_snapshots`.
+        frames_in_flight (int): Number of snapshots queued on the GPU
+            before the oldest is read back, see `make_snapshots`.
+        chunk_frames (int): Number of frames in a chunk.
+        max_chunks (int): Number of chunks the render thread may be ahead
+            of the consumer before it waits.
+    Yields:
+        Tuples of the index of the first frame and the frames of a chunk,
+        in order. Concatenated, the chunks are the snapshots returned by
+        `make_snapshots`. Leaving the iteration early stops rendering.
+    """
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+    sink = AsyncSink(loop, chunks,
+                     SnapshotThread.buffer_shape(beatmap, target_width,
+                                                 capture_rate,
+                                                 multichannel=multichannel),
+                     chunk_frames, max_chunks)
+    processor = SnapshotThread(beatmap, target_width, capture_rate, sink,
+                               device=device, curve_quality=curve_quality,
+                               multichannel=multichannel,
+                               max_tile_size=max_tile_size,
+                               frames_in_flight=frames_in_flight)
+    thread = threading.Thread(target=sink.render, args=(processor,),
+                              daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = await chunks.get()
+            sink.consumed()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                if isinstance(item, RenderCancelled):
+                    break
+                raise item
+            yield item
+    finally:
+        sink.cancel()
+        await loop.run_in_executor(None, thread.join)
+
+
+class AsyncSink(HandoverSink):
+    """Hand chunks from the render thread over to an event loop
+
+    Only the render thread waits for the consumer, the loop is never
+    blocked.
+    """
+
+    def __init__(self, loop, chunks, shape, chunk_frames, max_chunks):
+        super().__init__(shape, chunk_frames, max_chunks)
+        self._loop = loop
+        self._chunks = chunks
+
+    def deliver(self, item):
+        post(self._loop, self._chunks.put_nowait, item)
+
+
+def set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def set_exception(future, exception):
+    if not future.done():
+        future.set_exception(exception)
+
+
+def post(loop, callback, *args):
+    try:
+        loop.call_soon_threadsafe(callback, *args)
+    except RuntimeError:
+        # The loop is closed, nobody is waiting anymore
+        pass
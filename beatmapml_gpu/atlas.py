@@ -0,0 +1,218 @@
+from slider import Beatmap
+from slider.mod import ar_to_ms
+from collections import namedtuple
+from fractions import Fraction
+from numbers import Rational
+from typing import Iterable, List, Optional, Union
+import numpy as np
+import math
+import threading
+
+from .gl_backend import DEFAULT_FRAMES_IN_FLIGHT, GLBackend
+from .mods import NOMOD, parse_mods
+from .parameter_convert import calc_interval, calc_tick
+from .scene import BeatmapScene
+from .slider_process import calc_tolerance
+from .snapshot import SnapshotThread
+
+AtlasCell = namedtuple('AtlasCell', ['scene', 'interval',
+                                     'first', 'last', 'result'])
+
+
+def make_snapshots_atlas(beatmaps: List[Beatmap],
+                         target_width: int,
+                         capture_rate: Union[int, Rational],
+                         windows: int = 1,
+                         device: Optional[int] = None,
+                         curve_quality: float = 1.0,
+                         multichannel: bool = False,
+                         max_tile_size: Optional[int] = None,
+                         frames_in_flight: int = DEFAULT_FRAMES_IN_FLIGHT
+                         ) -> List[np.ndarray]:
+    """Make snapshots of several beatmaps side by side in one framebuffer
+    Args:
+        beatmaps (List[Beatmap]): The beatmaps to process.
+        target_width (int): The pixel width of desired output.
+        capture_rate (int or Fraction): The capture rate of the snapshots
+            in Hz.
+        windows (int): Number of time windows each beatmap is split into.
+            Every window takes its own cell of the framebuffer.
+        device (int): Index of the EGL device to render on. Defaults to
+            the default display.
+        curve_quality (float): Density of slider tessellation relative to
+            the output resolution, see `calc_tolerance`.
+        multichannel (bool): Write separate channels, see `make_snapshots`.
+        max_tile_size (int): Largest framebuffer side in pixels, see
+            `make_snapshots`. Cells larger than it are rendered tile by
+            tile.
+        frames_in_flight (int): Number of snapshots queued on the GPU
+            before the oldest is read back, see `make_snapshots`.
+    Returns:
+        A list of snapshots, one for each beatmap in the same order, each
+        as returned by `make_snapshots`. All cells are drawn into one
+        framebuffer and read back at once, which amortizes per-frame
+        overhead at small target widths.
+    """
+    results = [SnapshotThread.create_buffer(beatmap,
+                                            target_width,
+                                            capture_rate,
+                                            multichannel=multichannel)
+               for beatmap in beatmaps]
+    processor = AtlasThread(beatmaps, target_width, capture_rate, results,
+                            windows=windows, device=device,
+                            curve_quality=curve_quality,
+                            multichannel=multichannel,
+                            max_tile_size=max_tile_size,
+                            frames_in_flight=frames_in_flight)
+    # Render on this thread, so that errors reach the caller
+    processor.run()
+    return results
+
+
+def make_mod_snapshots(beatmap: Beatmap,
+                       target_width: int,
+                       capture_rate: Union[int, Rational],
+                       mods: List[Union[str, Iterable[str]]],
+                       device: Optional[int] = None,
+                       curve_quality: float = 1.0,
+                       multichannel: bool = False,
+                       max_tile_size: Optional[int] = None,
+                       frames_in_flight: int = DEFAULT_FRAMES_IN_FLIGHT
+                       ) -> List[np.ndarray]:
+    """Make snapshots of a beatmap under several mod combinations
+    Args:
+        beatmap (Beatmap): The beatmap to process.
+        target_width (int): The pixel width of desired output.
+        capture_rate (int or Fraction): The capture rate of the snapshots
+            in Hz of playback time.
+        mods (List[str]): The mod combinations, each as accepted by
+            `parse_mods`, e.g. ['NM', 'DT', 'HR', 'DTHR'].
+        device (int): Index of the EGL device to render on. Defaults to
+            the default display.
+        curve_quality (float): Density of slider tessellation relative to
+            the output resolution, see `calc_tolerance`.
+        multichannel (bool): Write separate channels, see `make_snapshots`.
+        max_tile_size (int): Largest framebuffer side in pixels, see
+            `make_snapshots`. Cells larger than it are rendered tile by
+            tile.
+        frames_in_flight (int): Number of snapshots queued on the GPU
+            before the oldest is read back, see `make_snapshots`.
+    Returns:
+        A list of snapshots, one for each mod combination in the same
+        order, each as returned by `make_snapshots`. The beatmap is parsed
+        and tessellated once, and all variants are rendered as cells of
+        one framebuffer.
+    """
+    variants = [parse_mods(m) for m in mods]
+    rates = [Fraction(capture_rate) / variant.rate for variant in variants]
+    results = [SnapshotThread.create_buffer(beatmap, target_width, rate,
+                                            multichannel=multichannel)
+               for rate in rates]
+    processor = AtlasThread([beatmap] * len(variants), target_width, rates,
+                            results, device=device,
+                            curve_quality=curve_quality, variants=variants,
+                            multichannel=multichannel,
+                            max_tile_size=max_tile_size,
+                            frames_in_flight=frames_in_flight)
+    # Render on this thread, so that errors reach the caller
+    processor.run()
+    return results
+
+
+class AtlasThread(threading.Thread):
+    def __init__(self, beatmaps, target_width, capture_rate, results,
+                 windows=1, device=None, curve_quality=1.0, variants=None,
+                 multichannel=False, max_tile_size=None,
+                 frames_in_flight=DEFAULT_FRAMES_IN_FLIGHT):
+        super().__init__()
+        self._beatmaps = beatmaps
+        self._target_width = target_width
+        if isinstance(capture_rate, (list, tuple)):
+            self._intervals = [calc_interval(rate) for rate in capture_rate]
+        else:
+            self._intervals = [calc_interval(capture_rate)] * len(beatmaps)
+        self._results = results
+        self._windows = windows
+        self._device = device
+        self._curve_quality = curve_quality
+        self._variants = variants or [NOMOD] * len(beatmaps)
+        self._multichannel = multichannel
+        self._max_tile_size = max_tile_size
+        self._frames_in_flight = frames_in_flight
+
+    def run(self):
+        num_cells = len(self._beatmaps) * self._windows
+        gl_backend = GLBackend(
+            self._target_width, self._beatmaps[0].circle_size,
+            ar_to_ms(self._beatmaps[0].approach_rate),
+            device=self._device, cells=num_cells,
+            multichannel=self._multichannel,
+            max_tile_size=self._max_tile_size,
+            frames_in_flight=self._frames_in_flight)
+        tolerance = calc_tolerance(gl_backend.osu_scale, self._curve_quality)
+
+        # The same beatmap played with different mods shares one scene
+        scenes = {}
+        cells = []
+        try:
+            for beatmap, variant, interval, result in zip(
+                    self._beatmaps, self._variants, self._intervals,
+                    self._results):
+                if id(beatmap) not in scenes:
+                    scene = BeatmapScene(beatmap, tolerance)
+                    scenes[id(beatmap)] = scene
+                    scene.equip(gl_backend)
+                scene = scenes[id(beatmap)].with_mods(variant)
+                window = math.ceil(result.shape[0] / self._windows)
+                for first in range(0, result.shape[0], window):
+                    cells.append(AtlasCell(
+                        scene, interval, first,
+                        min(first + window, result.shape[0]), result))
+
+            for start in range(0, len(cells), gl_backend.num_cells):
+                self.make_snapshots(gl_backend,
+                                    cells[start:start + gl_backend.num_cells])
+        finally:
+            for scene in scenes.values():
+                scene.release(gl_backend)
+            gl_backend.destroy()
+
+    def make_snapshots(self, gl_backend, cells):
+        num_steps = max(cell.last - cell.first for cell in cells)
+        for step in range(num_steps):
+            draws = []
+            for cell_idx, cell in enumerate(cells):
+                snapshot_idx = cell.first + step
+                if snapshot_idx >= cell.last:
+                    continue
+                tick = calc_tick(snapshot_idx, cell.interval)
+                circle_start, circle_end = cell.scene.query_circles(tick)
+                sliders = cell.scene.query_sliders(tick)
+                if circle_end > circle_start or len(sliders) > 0:
+                    draws.append((cell_idx, cell.scene, tick,
+                                  circle_start, circle_end, sliders))
+            if len(draws) == 0:
+                continue
+            for tile_idx, tile in enumerate(gl_backend.tiles):
+                gl_backend.set_tile(tile_idx)
+                gl_backend.setup()
+                for cell_idx, scene, *draw_args in draws:
+                    gl_backend.set_cell(cell_idx)
+                    scene.draw(gl_backend, *draw_args)
+                self.store(gl_backend,
+                           gl_backend.calc_avg((cells, step, tile)))
+
+        for ready in gl_backend.flush():
+            self.store(gl_backend, ready)
+
+    def store(self, gl_backend, ready):
+        if ready is not None:
+            (cells, step, tile), frame = ready
+            for cell, cell_frame in zip(cells,
+                                        gl_backend.split_cells(frame)):
+                if cell.first + step < cell.last:
+                    cell.result[cell.first + step, ...,
+                                tile.left:tile.right,
+                                tile.top:tile.bottom] = \
+                        cell_frame[..., :tile.right - tile.left,
+                                   :tile.bottom - tile.top]
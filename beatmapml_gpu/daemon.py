@@ -0,0 +1,311 @@
+from slider import Beatmap
+from fractions import Fraction
+from typing import Callable, Optional
+import numpy as np
+import argparse
+import json
+import os
+import queue
+import socket
+import socketserver
+import stat
+import threading
+import time
+
+from .gl_backend import DEFAULT_FRAMES_IN_FLIGHT, GLBackend
+from .snapshot import SnapshotThread
+from .storage import SnapshotWriter
+
+__all__ = [
+    'RenderDaemon',
+    'request_render',
+    'serve_queue',
+    'serve_socket'
+]
+
+PROGRESS_INTERVAL = 0.5
+DEFAULT_MAX_BUFFERS = 2
+DEFAULT_MAX_BACKENDS = 2
+
+
+class RenderDaemon(threading.Thread):
+    """Resident renderer serving jobs one after another
+
+    The daemon keeps one warm `GLBackend` for each target width and a pool
+    of output buffers, so that a job skips context creation and shader
+    compilation. A job is a dict with the keys
+
+        beatmap (str): Path of the .osu file.
+        width (int): The pixel width of desired output.
+        rate (int or str): The capture rate in Hz, a fraction like
+            '44100/512' is accepted.
+        output (str): Path to write. A .npy path gets a numpy array,
+            any other path a chunk-compressed file, see `SnapshotReader`.
+        multichannel (bool, optional): See `make_snapshots`.
+        curve_quality (float, optional): See `make_snapshots`.
+        id (optional): Echoed back in every event of the job.
+
+    Events are dicts with `event` being 'progress', 'done' or 'error'.
+
+    Args:
+        device (int): Index of the EGL device to render on. Defaults to
+            the default display.
+        max_buffers (int): Number of output buffers kept for reuse.
+        max_backends (int): Number of warm backends kept, the least
+            recently used is destroyed to make room for another.
+        max_tile_size (int): Largest framebuffer side in pixels, see
+            `make_snapshots`.
+        frames_in_flight (int): Number of snapshots queued on the GPU
+            before the oldest is read back, see `make_snapshots`.
+    """
+
+    def __init__(self, device=None, max_buffers=DEFAULT_MAX_BUFFERS,
+                 max_tile_size=None,
+                 frames_in_flight=DEFAULT_FRAMES_IN_FLIGHT,
+                 max_backends=DEFAULT_MAX_BACKENDS):
+        super().__init__(daemon=True)
+        self._device = device
+        self._max_tile_size = max_tile_size
+        self._frames_in_flight = frames_in_flight
+        self._max_buffers = max_buffers
+        self._max_backends = max_backends
+        self._jobs = queue.Queue()
+        self._backends = {}
+        self._buffers = []
+
+    def submit(self, job: dict, report: Callable[[dict], None]):
+        """Queue a job, events of the job are passed to report"""
+        self._jobs.put((job, report))
+
+    def stop(self):
+        """Stop after the queued jobs are done"""
+        self._jobs.put(None)
+
+    def run(self):
+        while True:
+            item = self._jobs.get()
+            if item is None:
+                break
+            job, report = item
+            self.process(job, report)
+        for gl_backend in self._backends.values():
+            gl_backend.destroy()
+        self._backends.clear()
+
+    def process(self, job, report):
+        event = {'id': job.get('id')}
+        key = None
+        try:
+            key = (int(job['width']), bool(job.get('multichannel', False)))
+            timing = self.render(job, key, report)
+        except Exception as e:
+            # Drop frames the failed job left in flight
+            if key in self._backends:
+                for _ in self._backends[key].flush():
+                    pass
+            report(dict(event, event='error',
+                        message='%s: %s' % (type(e).__name__, e)))
+        else:
+            report(dict(event, event='done', **timing))
+
+    def render(self, job, key, report):
+        start = time.perf_counter()
+        width, multichannel = key
+        beatmap = Beatmap.from_path(job['beatmap'])
+        rate = Fraction(job['rate'])
+        shape = SnapshotThread.buffer_shape(beatmap, width, rate,
+                                            multichannel=multichannel)
+        loaded = time.perf_counter()
+        gl_backend = self.backend(width, multichannel)
+        warm = time.perf_counter()
+
+        last_report = [0.0]
+
+        def progress(done, total):
+            now = time.perf_counter()
+            if now - last_report[0] >= PROGRESS_INTERVAL:
+                last_report[0] = now
+                report({'id': job.get('id'), 'event': 'progress',
+                        'done': done, 'total': total})
+
+        output = job['output']
+        to_numpy = output.endswith('.npy')
+        result = (self.buffer(shape) if to_numpy
+                  else SnapshotWriter(output, shape))
+        try:
+            processor = SnapshotThread(
+                beatmap, width, rate, result,
+                curve_quality=float(job.get('curve_quality', 1.0)),
+                multichannel=multichannel, progress=progress)
+            processor.render(gl_backend)
+            rendered = time.perf_counter()
+            if to_numpy:
+                np.save(output, result)
+            else:
+                result.close()
+        except BaseException:
+            # Never leave a file behind that reads as a finished render
+            if not to_numpy:
+                result.abort()
+            raise
+        finally:
+            if to_numpy:
+                self.recycle(result)
+        written = time.perf_counter()
+        return {'shape': list(shape),
+                'load_time': loaded - start,
+                'context_time': warm - loaded,
+                'render_time': rendered - warm,
+                'write_time': written - rendered}
+
+    def backend(self, width, multichannel):
+        key = (width, multichannel)
+        if key in self._backends:
+            # Reinsert to keep the dict ordered from least recently used
+            self._backends[key] = self._backends.pop(key)
+        else:
+            while len(self._backends) >= max(1, self._max_backends):
+                oldest = next(iter(self._backends))
+                self._backends.pop(oldest).destroy()
+            self._backends[key] = GLBackend(
+                width, 0, 0, device=self._device,
+                max_tile_size=self._max_tile_size,
+                frames_in_flight=self._frames_in_flight,
+                multichannel=multichannel)
+        self._backends[key].make_current()
+        return self._backends[key]
+
+    def buffer(self, shape):
+        size = int(np.prod(shape))
+        for i, flat in enumerate(self._buffers):
+            if flat.size >= size:
+                del self._buffers[i]
+                return flat[:size].reshape(shape)
+        return np.empty(shape, dtype=np.float32)
+
+    def recycle(self, result):
+        flat = result.base if result.base is not None else result
+        self._buffers.append(flat.reshape(-1))
+        self._buffers.sort(key=lambda b: b.size)
+        if len(self._buffers) > self._max_buffers:
+            del self._buffers[0]
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            events = queue.Queue()
+            try:
+                job = json.loads(line.decode())
+            except ValueError as e:
+                self.send({'event': 'error', 'message': str(e)})
+                continue
+            self.server.daemon_thread.submit(job, events.put)
+            while True:
+                event = events.get()
+                self.send(event)
+                if event['event'] != 'progress':
+                    break
+
+    def send(self, event):
+        self.wfile.write(json.dumps(event).encode() + b'\n')
+        self.wfile.flush()
+
+
+def serve_socket(path: str, device: Optional[int] = None,
+                 max_tile_size: Optional[int] = None,
+                 frames_in_flight: int = DEFAULT_FRAMES_IN_FLIGHT):
+    """Serve render jobs on a Unix socket until interrupted
+
+    Each line sent to the socket is a job as described in `RenderDaemon`,
+    encoded in JSON. Events of the job are sent back one JSON per line,
+    and the next job of a connection is read once the previous is done or
+    failed. Jobs from all connections are rendered one at a time.
+    """
+    if os.path.lexists(path):
+        # Only replace the socket of a previous run, never a regular file
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            raise FileExistsError('%s exists and is not a socket' % path)
+        os.unlink(path)
+    daemon = RenderDaemon(device=device, max_tile_size=max_tile_size,
+                          frames_in_flight=frames_in_flight)
+    daemon.start()
+    with socketserver.ThreadingUnixStreamServer(path, JobHandler) as server:
+        server.daemon_threads = True
+        server.daemon_thread = daemon
+        try:
+            server.serve_forever()
+        finally:
+            daemon.stop()
+            daemon.join()
+            os.unlink(path)
+
+
+def serve_queue(jobs, events, device: Optional[int] = None,
+                max_tile_size: Optional[int] = None,
+                frames_in_flight: int = DEFAULT_FRAMES_IN_FLIGHT):
+    """Serve render jobs from a multiprocessing queue
+
+    Jobs as described in `RenderDaemon` are read from jobs until None is
+    received, and their events are put into events. Meant as the target
+    of a `multiprocessing.Process`.
+    """
+    daemon = RenderDaemon(device=device, max_tile_size=max_tile_size,
+                          frames_in_flight=frames_in_flight)
+    daemon.start()
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        daemon.submit(job, events.put)
+    daemon.stop()
+    daemon.join()
+
+
+def request_render(path: str, job: dict,
+                   progress: Optional[Callable[[dict], None]] = None) -> dict:
+    """Submit a job to a daemon listening on a Unix socket and wait
+
+    Args:
+        path (str): Path of the socket, see `serve_socket`.
+        job (dict): The job, see `RenderDaemon`.
+        progress (Callable): Called with each progress event.
+    Returns:
+        The final event of the job, with timing if it is done.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path)
+        conn.sendall(json.dumps(job).encode() + b'\n')
+        for line in conn.makefile('rb'):
+            event = json.loads(line.decode())
+            if event['event'] != 'progress':
+                return event
+            if progress is not None:
+                progress(event)
+    raise ConnectionError('Daemon closed the connection')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve beatmap rendering jobs from warm GL contexts')
+    parser.add_argument('socket', help='path of the Unix socket to serve on')
+    parser.add_argument('--device', type=int, default=None,
+                        help='index of the EGL device to render on')
+    parser.add_argument('--max-tile-size', type=int, default=None,
+                        help='largest framebuffer side in pixels')
+    parser.add_argument('--frames-in-flight', type=int,
+                        default=DEFAULT_FRAMES_IN_FLIGHT,
+                        help='number of snapshots queued on the GPU')
+    args = parser.parse_args()
+    try:
+        serve_socket(args.socket, device=args.device,
+                     max_tile_size=args.max_tile_size,
+                     frames_in_flight=args.frames_in_flight)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
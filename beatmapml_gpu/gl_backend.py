@@ -1,23 +1,104 @@
 from .env import USE_EGL
 from OpenGL.GL import *
 from OpenGL import arrays
+from OpenGL.error import Error as GLBaseError, NullFunctionError
 from slider.mod import circle_radius
 import numpy as np
 import ctypes
 import math
+import threading
+from collections import deque
 
-from .parameter_convert import calc_dimension, MAX_PLAYFIELD
+from .parameter_convert import calc_dimension, calc_osu_scale, MAX_PLAYFIELD
+from .structs import Dimension, Rect
 from .shaders import *
 
 if USE_EGL:
     from OpenGL.EGL import *
+    from OpenGL.EGL.EXT.device_enumeration import eglQueryDevicesEXT
+    from OpenGL.EGL.EXT.device_query import eglQueryDeviceStringEXT
+    from OpenGL.EGL.EXT.platform_base import eglGetPlatformDisplayEXT
+    from OpenGL.EGL.EXT.platform_device import EGL_PLATFORM_DEVICE_EXT
+
+DEFAULT_FRAMES_IN_FLIGHT = 3
+FENCE_TIMEOUT_NS = 1000000000
+# Channels of multichannel snapshots, in order
+CHANNELS = ['circle', 'slider', 'progress', 'overlap']
+
+# Displays are shared by every context on the same device, so they are
+# only terminated once the last backend using them is destroyed
+_display_lock = threading.Lock()
+_display_refs = {}
+
+
+def display_key(display):
+    return ctypes.cast(display, ctypes.c_void_p).value
+
+
+def query_devices():
+    """Enumerate the EGL devices available for rendering
+
+        Returns:
+            A list of EGL device handles. The list is empty if the platform
+            is not EGL or the driver does not support device enumeration.
+    """
+    if not USE_EGL:
+        return []
+    try:
+        num_devices = EGLint()
+        if not eglQueryDevicesEXT(0, None, ctypes.pointer(num_devices)):
+            return []
+        devices = (EGLDeviceEXT * num_devices.value)()
+        if not eglQueryDevicesEXT(num_devices.value, devices,
+                                  ctypes.pointer(num_devices)):
+            return []
+    except (NullFunctionError, GLBaseError):
+        return []
+    return list(devices[:num_devices.value])
+
+
+def is_software_device(device):
+    """Whether an EGL device is a CPU rasterizer like Mesa's llvmpipe"""
+    try:
+        extensions = eglQueryDeviceStringEXT(device, EGL_EXTENSIONS)
+    except (NullFunctionError, GLBaseError):
+        return False
+    return b'EGL_MESA_device_software' in (extensions or b'').split()
+
+
+def query_hardware_devices():
+    """Indices of the EGL devices to render on by default
+
+        Returns:
+            Indices into `query_devices` of every device that is not a
+            software rasterizer, or of every device if there is no other.
+    """
+    devices = query_devices()
+    hardware = [idx for idx, device in enumerate(devices)
+                if not is_software_device(device)]
+    return hardware if len(hardware) > 0 else list(range(len(devices)))
 
 
 class GLBackend():
-    def __init__(self, width, cs, lookahead):
+    def __init__(self, width, cs, lookahead, device=None,
+                 frames_in_flight=DEFAULT_FRAMES_IN_FLIGHT, cells=1,
+                 max_tile_size=None, multichannel=False):
+        if frames_in_flight < 1:
+            raise ValueError('At least one frame must be in flight, got %r' %
+                             frames_in_flight)
         self._canvas_size, self._field = calc_dimension(width)
         self._cs = circle_radius(cs)
         self._lookahead = lookahead
+        self._device = device
+        self._frames_in_flight = frames_in_flight
+        self._cells = cells
+        self._max_tile_size = max_tile_size
+        self._flip = False
+        self._multichannel = multichannel
+        self._num_channels = len(CHANNELS) if multichannel else 1
+        self._pending = deque()
+        self._next_slot = 0
+        self._geometry_buffers = {}
 
         self.init_matrix()
         self.init_context()
@@ -48,8 +129,11 @@ class GLBackend():
         ]
 
         major, minor = ctypes.c_long(), ctypes.c_long()
-        self._display = eglGetDisplay(EGL_DEFAULT_DISPLAY)
-        eglInitialize(self._display, major, minor)
+        self._display = self.get_display()
+        with _display_lock:
+            eglInitialize(self._display, major, minor)
+            key = display_key(self._display)
+            _display_refs[key] = _display_refs.get(key, 0) + 1
 
         num_configs = ctypes.c_long()
         config = (EGLConfig * 2)()
@@ -63,14 +147,37 @@ class GLBackend():
             EGL_NONE
         ]
         opengl_attributes = arrays.GLintArray.asArray(OPENGL_ATTRIBUTES)
-        ctx = eglCreateContext(
+        self._context = eglCreateContext(
             self._display, config[0], EGL_NO_CONTEXT, opengl_attributes)
-        eglMakeCurrent(self._display, EGL_NO_SURFACE,
-                       EGL_NO_SURFACE, ctx)
+        self.make_current()
+
+    def make_current(self):
+        if USE_EGL:
+            eglMakeCurrent(self._display, EGL_NO_SURFACE,
+                           EGL_NO_SURFACE, self._context)
+
+    def get_display(self):
+        if self._device is not None:
+            devices = query_devices()
+            if len(devices) > 0:
+                if not 0 <= self._device < len(devices):
+                    raise ValueError('EGL device %d out of range, %d found' %
+                                     (self._device, len(devices)))
+                return eglGetPlatformDisplayEXT(EGL_PLATFORM_DEVICE_EXT,
+                                                devices[self._device], None)
+        return eglGetDisplay(EGL_DEFAULT_DISPLAY)
 
     def destroy(self):
         if USE_EGL:
-            eglTerminate(self._display)
+            eglMakeCurrent(self._display, EGL_NO_SURFACE,
+                           EGL_NO_SURFACE, EGL_NO_CONTEXT)
+            eglDestroyContext(self._display, self._context)
+            with _display_lock:
+                key = display_key(self._display)
+                _display_refs[key] -= 1
+                if _display_refs[key] == 0:
+                    del _display_refs[key]
+                    eglTerminate(self._display)
 
     def init_gl(self):
         glShadeModel(GL_SMOOTH)
@@ -80,6 +187,8 @@ class GLBackend():
         glBlendEquation(GL_FUNC_ADD)
         glBlendFunc(GL_ONE, GL_ONE)
 
+        self.init_tiles()
+        self.init_atlas()
         self.init_framebuffer()
 
         quad_vbo = np.array([[-1.0, -1.0],
@@ -127,18 +236,20 @@ class GLBackend():
         glUseProgram(self._disk_program)
         self._disk_tick_uniform = glGetUniformLocation(
             self._disk_program, 'tick')
-        lookahead_uniform = glGetUniformLocation(
+        self._disk_lookahead_uniform = glGetUniformLocation(
             self._disk_program, 'lookahead')
-        glUniform1f(lookahead_uniform, self._lookahead)
-        radius_uniform = glGetUniformLocation(
+        glUniform1f(self._disk_lookahead_uniform, self._lookahead)
+        self._disk_radius_uniform = glGetUniformLocation(
             self._disk_program, 'radius')
-        glUniform1f(radius_uniform, self._cs)
-        osu2canvas_uniform = glGetUniformLocation(
+        glUniform1f(self._disk_radius_uniform, self._cs)
+        self._disk_osu2canvas_uniform = glGetUniformLocation(
             self._disk_program, 'osuToCanvas')
-        glUniformMatrix4fv(osu2canvas_uniform, 1, True, self._osu_to_canvas)
-        projection_uniform = glGetUniformLocation(
+        glUniformMatrix4fv(self._disk_osu2canvas_uniform, 1, True,
+                           self._osu_to_canvas)
+        self._disk_projection_uniform = glGetUniformLocation(
             self._disk_program, 'projection')
-        glUniformMatrix4fv(projection_uniform, 1, True, self._projection)
+        glUniformMatrix4fv(self._disk_projection_uniform, 1, True,
+                           self._projection)
 
     def init_slider_shader(self):
         vertexID = self.compileShader(SLIDER_VERTEX_SHADER,
@@ -167,31 +278,24 @@ class GLBackend():
         glDeleteShader(fragmentID)
 
         glUseProgram(self._slider_program)
-        lookahead_uniform = glGetUniformLocation(
+        self._slider_lookahead_uniform = glGetUniformLocation(
             self._slider_program, 'lookahead')
-        glUniform1f(lookahead_uniform, self._lookahead)
-        radius_uniform = glGetUniformLocation(
+        glUniform1f(self._slider_lookahead_uniform, self._lookahead)
+        self._slider_radius_uniform = glGetUniformLocation(
             self._slider_program, 'radius')
-        glUniform1f(radius_uniform, self._cs)
-        osu2canvas_uniform = glGetUniformLocation(
+        glUniform1f(self._slider_radius_uniform, self._cs)
+        self._slider_osu2canvas_uniform = glGetUniformLocation(
             self._slider_program, 'osuToCanvas')
-        glUniformMatrix4fv(osu2canvas_uniform, 1, True, self._osu_to_canvas)
-        projection_uniform = glGetUniformLocation(
+        glUniformMatrix4fv(self._slider_osu2canvas_uniform, 1, True,
+                           self._osu_to_canvas)
+        self._slider_projection_uniform = glGetUniformLocation(
             self._slider_program, 'projection')
-        glUniformMatrix4fv(projection_uniform, 1, True, self._projection)
+        glUniformMatrix4fv(self._slider_projection_uniform, 1, True,
+                           self._projection)
 
-        max_steps = min(50, math.floor(self._cs))
-        samples = np.linspace(0, math.pi, max_steps, dtype=np.float32)
-        rotate_cos = np.cos(samples)
-        rotate_sin = np.sin(samples)
-        rotate = np.empty((48, 2, 2), dtype=np.float32)
-        rotate[0:max_steps - 2, 0, 0] = rotate_cos[1:-1]
-        rotate[0:max_steps - 2, 1, 1] = rotate_cos[1:-1]
-        rotate[0:max_steps - 2, 0, 1] = -rotate_sin[1:-1]
-        rotate[0:max_steps - 2, 1, 0] = rotate_sin[1:-1]
-        rotate_uniform = glGetUniformLocation(
+        self._slider_rotate_uniform = glGetUniformLocation(
             self._slider_program, 'rotate')
-        glUniformMatrix2fv(rotate_uniform, 48, True, rotate)
+        self.set_rotate()
 
         self._slider_tick_uniform = glGetUniformLocation(
             self._slider_program, 'tick')
@@ -202,23 +306,50 @@ class GLBackend():
         self._slider_repeat = glGetUniformLocation(
             self._slider_program, 'repeat')
 
-        self._slider_vaoid = glGenVertexArrays(1)
-        glBindVertexArray(self._slider_vaoid)
-
         self._slider_position_attrib = glGetAttribLocation(
             self._slider_program, 'position')
         self._slider_cumLength_attrib = glGetAttribLocation(
             self._slider_program, 'cumLength')
 
-        glEnableVertexAttribArray(self._slider_position_attrib)
-        glEnableVertexAttribArray(self._slider_cumLength_attrib)
-        glBindVertexArray(0)
+    def set_rotate(self):
+        max_steps = min(50, math.floor(self._cs))
+        samples = np.linspace(0, math.pi, max_steps, dtype=np.float32)
+        rotate_cos = np.cos(samples)
+        rotate_sin = np.sin(samples)
+        rotate = np.empty((48, 2, 2), dtype=np.float32)
+        rotate[0:max_steps - 2, 0, 0] = rotate_cos[1:-1]
+        rotate[0:max_steps - 2, 1, 1] = rotate_cos[1:-1]
+        rotate[0:max_steps - 2, 0, 1] = -rotate_sin[1:-1]
+        rotate[0:max_steps - 2, 1, 0] = rotate_sin[1:-1]
+        glUniformMatrix2fv(self._slider_rotate_uniform, 48, True, rotate)
+
+    def set_circle_size(self, cs):
+        radius = circle_radius(cs)
+        if radius == self._cs:
+            return
+        self._cs = radius
+        glUseProgram(self._disk_program)
+        glUniform1f(self._disk_radius_uniform, self._cs)
+        glUseProgram(self._slider_program)
+        glUniform1f(self._slider_radius_uniform, self._cs)
+        self.set_rotate()
+
+    def set_lookahead(self, lookahead):
+        if lookahead == self._lookahead:
+            return
+        self._lookahead = lookahead
+        glUseProgram(self._disk_program)
+        glUniform1f(self._disk_lookahead_uniform, self._lookahead)
+        glUseProgram(self._slider_program)
+        glUniform1f(self._slider_lookahead_uniform, self._lookahead)
 
     def init_avg_shader(self):
         vertexID = self.compileShader(AVG_VERTEX_SHADER,
                                       GL_VERTEX_SHADER)
-        fragmentID = self.compileShader(AVG_FRAGMENT_SHADER,
-                                        GL_FRAGMENT_SHADER)
+        fragmentID = self.compileShader(
+            MULTI_AVG_FRAGMENT_SHADER if self._multichannel
+            else AVG_FRAGMENT_SHADER,
+            GL_FRAGMENT_SHADER)
         self._avg_program = glCreateProgram()
         glAttachShader(self._avg_program, vertexID)
         glAttachShader(self._avg_program, fragmentID)
@@ -246,6 +377,8 @@ class GLBackend():
 
         self._avg_sampler_uniform = glGetUniformLocation(
             self._avg_program, 'avgSampler')
+        self._kind_sampler_uniform = glGetUniformLocation(
+            self._avg_program, 'kindSampler')
 
     def compileShader(self, source, shader_type):
         shader = glCreateShader(shader_type)
@@ -255,34 +388,146 @@ class GLBackend():
             raise RuntimeError(glGetShaderInfoLog(shader).decode())
         return shader
 
+    def set_flip(self, flip):
+        if flip == self._flip:
+            return
+        self._flip = flip
+        osu_to_canvas = self._osu_to_canvas.copy()
+        if flip:
+            # Mirror the playfield vertically as HardRock does
+            osu_to_canvas[1, 3] += osu_to_canvas[1, 1] * MAX_PLAYFIELD[1]
+            osu_to_canvas[1, 1] = -osu_to_canvas[1, 1]
+        glUseProgram(self._disk_program)
+        glUniformMatrix4fv(self._disk_osu2canvas_uniform, 1, True,
+                           osu_to_canvas)
+        glUseProgram(self._slider_program)
+        glUniformMatrix4fv(self._slider_osu2canvas_uniform, 1, True,
+                           osu_to_canvas)
+
+    def init_tiles(self):
+        self._max_size = min(int(glGetIntegerv(GL_MAX_TEXTURE_SIZE)),
+                             *(int(d) for d in
+                               glGetIntegerv(GL_MAX_VIEWPORT_DIMS)))
+        if self._max_tile_size is not None:
+            self._max_size = min(self._max_size, self._max_tile_size)
+        (w, h) = self._canvas_size
+        self._tile_size = Dimension(min(w, self._max_size),
+                                    min(h, self._max_size))
+        self._tiles = [Rect(left, top,
+                            min(left + self._tile_size.w, w),
+                            min(top + self._tile_size.h, h))
+                       for top in range(0, h, self._tile_size.h)
+                       for left in range(0, w, self._tile_size.w)]
+        self._current_tile = 0
+        self._projection = self.tile_projection(self._tiles[0])
+
+    @property
+    def tiles(self):
+        """Regions of the canvas rendered one after another, in pixels"""
+        return self._tiles
+
+    def tile_projection(self, tile):
+        (w, h) = self._tile_size
+        return np.array([[2 / w, 0, 0, -1 - 2 * tile.left / w],
+                         [0, 2 / h, 0, -1 - 2 * tile.top / h],
+                         [0, 0, 1, 0],
+                         [0, 0, 0, 1]], dtype=np.float32)
+
+    def set_tile(self, tile):
+        if tile == self._current_tile:
+            return
+        self._current_tile = tile
+        projection = self.tile_projection(self._tiles[tile])
+        glUseProgram(self._disk_program)
+        glUniformMatrix4fv(self._disk_projection_uniform, 1, True, projection)
+        glUseProgram(self._slider_program)
+        glUniformMatrix4fv(self._slider_projection_uniform, 1, True,
+                           projection)
+
+    def init_atlas(self):
+        (w, h) = self._tile_size
+        columns = min(math.ceil(math.sqrt(self._cells)),
+                      max(1, self._max_size // w))
+        rows = min(math.ceil(self._cells / columns),
+                   max(1, self._max_size // h))
+        self._grid = Dimension(columns, rows)
+        self._target_size = Dimension(columns * w, rows * h)
+
+    @property
+    def num_cells(self):
+        """Number of beatmaps that fit side by side in the framebuffer"""
+        return self._grid.w * self._grid.h
+
+    def set_cell(self, cell):
+        (w, h) = self._tile_size
+        glViewport((cell % self._grid.w) * w, (cell // self._grid.w) * h,
+                   w, h)
+
+    def split_cells(self, frame):
+        (w, h) = self._tile_size
+        return [frame[...,
+                      (cell % self._grid.w) * w:
+                      (cell % self._grid.w + 1) * w,
+                      (cell // self._grid.w) * h:
+                      (cell // self._grid.w + 1) * h]
+                for cell in range(self.num_cells)]
+
     def init_framebuffer(self):
         self._framebuffer = glGenFramebuffers(1)
         glBindFramebuffer(GL_FRAMEBUFFER, self._framebuffer)
         self._texture = glGenTextures(1)
         glBindTexture(GL_TEXTURE_2D, self._texture)
         glTexStorage2D(GL_TEXTURE_2D, 1, GL_RG32F,
-                       self._canvas_size.w, self._canvas_size.h)
+                       self._target_size.w, self._target_size.h)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
         glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0,
                                GL_TEXTURE_2D, self._texture, 0)
-        draw_buffer = np.array([GL_COLOR_ATTACHMENT0], dtype=np.uint32)
-        glDrawBuffers(draw_buffer)
+        draw_buffer = [GL_COLOR_ATTACHMENT0]
+        if self._multichannel:
+            # Circle and slider coverage, written in the same pass
+            self._kind_texture = glGenTextures(1)
+            glBindTexture(GL_TEXTURE_2D, self._kind_texture)
+            glTexStorage2D(GL_TEXTURE_2D, 1, GL_RG32F,
+                           self._target_size.w, self._target_size.h)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+            glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT1,
+                                   GL_TEXTURE_2D, self._kind_texture, 0)
+            draw_buffer.append(GL_COLOR_ATTACHMENT1)
+        glDrawBuffers(np.array(draw_buffer, dtype=np.uint32))
         if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
             raise RuntimeError("Cannot initiate framebuffer as texture")
 
-        self._result_framebuffer = glGenFramebuffers(1)
-        glBindFramebuffer(GL_FRAMEBUFFER, self._result_framebuffer)
+        self._result_framebuffers = []
+        self._pixel_buffers = []
+        for _ in range(self._frames_in_flight):
+            self.init_result_slot()
+
+    def init_result_slot(self):
+        result_framebuffer = glGenFramebuffers(1)
+        glBindFramebuffer(GL_FRAMEBUFFER, result_framebuffer)
         result_texture = glGenTextures(1)
         glBindTexture(GL_TEXTURE_2D, result_texture)
-        glTexStorage2D(GL_TEXTURE_2D, 1, GL_R32F,
-                       self._canvas_size.w, self._canvas_size.h)
+        glTexStorage2D(GL_TEXTURE_2D, 1,
+                       GL_RGBA32F if self._multichannel else GL_R32F,
+                       self._target_size.w, self._target_size.h)
         glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0,
                                GL_TEXTURE_2D, result_texture, 0)
         draw_buffer = np.array([GL_COLOR_ATTACHMENT0], dtype=np.uint32)
         glDrawBuffers(draw_buffer)
         if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
             raise RuntimeError("Cannot initiate framebuffer as texture")
+        self._result_framebuffers.append(result_framebuffer)
+
+        pixel_buffer = glGenBuffers(1)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pixel_buffer)
+        glBufferData(GL_PIXEL_PACK_BUFFER,
+                     self._target_size.w * self._target_size.h *
+                     self._num_channels * 4,
+                     None, GL_STREAM_READ)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self._pixel_buffers.append(pixel_buffer)
 
     def init_matrix(self):
         (l, t, r, b) = self._field
@@ -296,15 +541,20 @@ class GLBackend():
                                      [0, 0, 1, 0],
                                      [0, 0, 0, 1]], dtype=np.float32)
 
+    @property
+    def osu_scale(self):
+        """Canvas pixels per osu!pixel of the osuToCanvas transformation"""
+        return calc_osu_scale(self._canvas_size.w)
+
     def equip_circles(self, hitcircles):
         vbo = np.array([[c.position.x,
                          c.position.y,
                          c.time_ms]
                         for c in hitcircles], dtype=np.float32)
-        self._circle_vboid = glGenBuffers(1)
+        circle_vboid = glGenBuffers(1)
         self._circle_vaoid = glGenVertexArrays(1)
         glBindVertexArray(self._circle_vaoid)
-        glBindBuffer(GL_ARRAY_BUFFER, self._circle_vboid)
+        glBindBuffer(GL_ARRAY_BUFFER, circle_vboid)
         glBufferData(GL_ARRAY_BUFFER, vbo.nbytes, vbo, GL_STATIC_DRAW)
 
         disk_position_attrib = glGetAttribLocation(
@@ -319,24 +569,40 @@ class GLBackend():
         glVertexAttribPointer(disk_activation_attrib,
                               1, GL_FLOAT, GL_FALSE, 12, ctypes.c_void_p(8))
         glBindVertexArray(0)
+        self._geometry_buffers[self._circle_vaoid] = circle_vboid
+        return self._circle_vaoid
 
-    def equip_sliders(self, sliders):
-        vboids = (GLint * len(sliders))()
-        glGenBuffers(len(sliders), vboids)
-        vboids = np.array(vboids)
-        for i in range(len(sliders)):
-            slider = sliders[i]
-            slider.vboid = vboids[i]
-            vbo = slider.linearization
-            glBindBuffer(GL_ARRAY_BUFFER, slider.vboid)
-            glBufferData(GL_ARRAY_BUFFER, vbo.nbytes, vbo, GL_STATIC_DRAW)
+    def equip_sliders(self, vertices):
+        slider_vboid = glGenBuffers(1)
+        self._slider_vaoid = glGenVertexArrays(1)
+        glBindVertexArray(self._slider_vaoid)
+        glBindBuffer(GL_ARRAY_BUFFER, slider_vboid)
+        glBufferData(GL_ARRAY_BUFFER, vertices.nbytes,
+                     vertices, GL_STATIC_DRAW)
 
-    def unequip_sliders(self, sliders):
-        glDeleteBuffers(len(sliders), [slider.vboid for slider in sliders])
+        glEnableVertexAttribArray(self._slider_position_attrib)
+        glEnableVertexAttribArray(self._slider_cumLength_attrib)
+        glVertexAttribPointer(self._slider_position_attrib,
+                              2, GL_FLOAT, GL_FALSE, 12, None)
+        glVertexAttribPointer(self._slider_cumLength_attrib,
+                              1, GL_FLOAT, GL_FALSE, 12,
+                              ctypes.c_void_p(8))
+        glBindVertexArray(0)
+        self._geometry_buffers[self._slider_vaoid] = slider_vboid
+        return self._slider_vaoid
+
+    def release_geometry(self, *vaoids):
+        for vaoid in vaoids:
+            glDeleteBuffers(1, [self._geometry_buffers.pop(vaoid)])
+            glDeleteVertexArrays(1, [vaoid])
+
+    def use_geometry(self, circle_vaoid, slider_vaoid):
+        self._circle_vaoid = circle_vaoid
+        self._slider_vaoid = slider_vaoid
 
     def setup(self):
         glBindFramebuffer(GL_FRAMEBUFFER, self._framebuffer)
-        glViewport(0, 0, self._canvas_size.w, self._canvas_size.h)
+        glViewport(0, 0, self._tile_size.w, self._tile_size.h)
         glClear(GL_COLOR_BUFFER_BIT)
 
     def render_circles(self, tick, start, end):
@@ -356,20 +622,18 @@ class GLBackend():
         glUniform1f(self._slider_activation_uniform, slider.time_ms)
         glUniform1f(self._slider_total_time, slider.total_time)
         glUniform1i(self._slider_repeat, slider.repeat)
-        glBindBuffer(GL_ARRAY_BUFFER, slider.vboid)
 
-        glVertexAttribPointer(self._slider_position_attrib,
-                              2, GL_FLOAT, GL_FALSE, 12, None)
-        glVertexAttribPointer(self._slider_cumLength_attrib,
-                              1, GL_FLOAT, GL_FALSE, 12,
-                              ctypes.c_void_p(8))
+        glDrawArrays(GL_LINE_STRIP_ADJACENCY, slider.first, slider.count)
 
-        glDrawArrays(GL_LINE_STRIP_ADJACENCY, 0, slider.linearization.shape[0])
+    def calc_avg(self, tag):
+        ready = None
+        if len(self._pending) == self._frames_in_flight:
+            ready = self.resolve()
 
-    def calc_avg(self):
-        glFinish()
-        glBindFramebuffer(GL_FRAMEBUFFER, self._result_framebuffer)
-        glViewport(0, 0, self._canvas_size.w, self._canvas_size.h)
+        slot = self._next_slot
+        self._next_slot = (slot + 1) % self._frames_in_flight
+        glBindFramebuffer(GL_FRAMEBUFFER, self._result_framebuffers[slot])
+        glViewport(0, 0, self._target_size.w, self._target_size.h)
         glClear(GL_COLOR_BUFFER_BIT)
         glUseProgram(self._avg_program)
         glBindVertexArray(self._quad_vaoid)
@@ -377,16 +641,53 @@ class GLBackend():
         glActiveTexture(GL_TEXTURE0)
         glBindTexture(GL_TEXTURE_2D, self._texture)
         glUniform1i(self._avg_sampler_uniform, 0)
+        if self._multichannel:
+            glActiveTexture(GL_TEXTURE1)
+            glBindTexture(GL_TEXTURE_2D, self._kind_texture)
+            glUniform1i(self._kind_sampler_uniform, 1)
 
         glDrawArrays(GL_TRIANGLES, 0, 6)
-        glFinish()
-
-        return self.read_pixels()
 
-    def read_pixels(self):
-        buf = glReadPixels(0, 0,
-                           self._canvas_size.w,
-                           self._canvas_size.h,
-                           GL_RED, GL_FLOAT)
-        return buf.reshape((self._canvas_size.h,
-                            self._canvas_size.w)).transpose()
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self._pixel_buffers[slot])
+        glReadPixels(0, 0,
+                     self._target_size.w,
+                     self._target_size.h,
+                     GL_RGBA if self._multichannel else GL_RED,
+                     GL_FLOAT, 0)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        fence = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self._pending.append((tag, slot, fence))
+
+        return ready
+
+    def flush(self):
+        while len(self._pending) > 0:
+            yield self.resolve()
+
+    def resolve(self):
+        tag, slot, fence = self._pending.popleft()
+        while True:
+            status = glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT,
+                                      FENCE_TIMEOUT_NS)
+            if status == GL_WAIT_FAILED:
+                raise RuntimeError("Failed to wait for rendering to finish")
+            if status != GL_TIMEOUT_EXPIRED:
+                break
+        glDeleteSync(fence)
+        return tag, self.read_pixels(slot)
+
+    def read_pixels(self, slot):
+        buf = np.empty(self._target_size.w * self._target_size.h *
+                       self._num_channels, dtype=np.float32)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self._pixel_buffers[slot])
+        pointer = glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, buf.nbytes,
+                                   GL_MAP_READ_BIT)
+        ctypes.memmove(buf.ctypes.data, pointer, buf.nbytes)
+        glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        if self._multichannel:
+            return buf.reshape((self._target_size.h,
+                                self._target_size.w,
+                                self._num_channels)).transpose((2, 1, 0))
+        return buf.reshape((self._target_size.h,
+                            self._target_size.w)).transpose()
@@ -0,0 +1,53 @@
+from collections import namedtuple
+from fractions import Fraction
+from typing import Iterable, Union
+
+__all__ = [
+    'ModVariant',
+    'parse_mods'
+]
+
+ModVariant = namedtuple('ModVariant', ['name', 'rate', 'flip',
+                                       'cs_scale', 'ar_scale'])
+
+NOMOD = ModVariant('NM', Fraction(1), False, 1, 1)
+
+MOD_CODES = {'NM', 'DT', 'NC', 'HT', 'HR', 'EZ'}
+
+
+def parse_mods(mods: Union[str, Iterable[str]]) -> ModVariant:
+    """Parse a combination of mods affecting the playfield
+
+        Args:
+            mods (str or Iterable[str]): Two-letter mod codes, either
+                concatenated as in 'DTHR' or as a list like ['DT', 'HR'].
+                Supported are DT, NC, HT, HR, EZ and NM for no mod.
+
+        Returns:
+            The variant of the beatmap played with the mods.
+    """
+    if isinstance(mods, str):
+        if len(mods) % 2 != 0:
+            raise ValueError('Invalid mod combination: %r' % mods)
+        codes = [mods[i:i + 2] for i in range(0, len(mods), 2)]
+    else:
+        codes = list(mods)
+    codes = {code.upper() for code in codes}
+    unknown = codes - MOD_CODES
+    if len(unknown) > 0:
+        raise ValueError('Unsupported mods: %s' % ', '.join(sorted(unknown)))
+    if 'HT' in codes and codes & {'DT', 'NC'}:
+        raise ValueError('HT cannot be combined with DT or NC')
+    if {'HR', 'EZ'} <= codes:
+        raise ValueError('HR cannot be combined with EZ')
+
+    variant = NOMOD._replace(name=''.join(sorted(codes - {'NM'})) or 'NM')
+    if codes & {'DT', 'NC'}:
+        variant = variant._replace(rate=Fraction(3, 2))
+    if 'HT' in codes:
+        variant = variant._replace(rate=Fraction(3, 4))
+    if 'HR' in codes:
+        variant = variant._replace(flip=True, cs_scale=1.3, ar_scale=1.4)
+    if 'EZ' in codes:
+        variant = variant._replace(cs_scale=0.5, ar_scale=0.5)
+    return variant
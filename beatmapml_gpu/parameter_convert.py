@@ -1,4 +1,8 @@
 from slider.mod import circle_radius
+from datetime import timedelta
+from fractions import Fraction
+from numbers import Rational
+from typing import Union
 import numpy as np
 import math
 
@@ -7,6 +11,11 @@ from .structs import *
 __all__ = [
     'calc_cs_propotion',
     'calc_dimension',
+    'calc_osu_scale',
+    'calc_audio_capture_rate',
+    'calc_interval',
+    'calc_tick',
+    'calc_num_slice',
     'MAX_PLAYFIELD'
 ]
 MAX_PLAYFIELD = np.array([512, 384])
@@ -37,3 +46,56 @@ def calc_dimension(width):
                  MAX_CS_RADIUS,
                  MAX_CS_RADIUS + field_width,
                  MAX_CS_RADIUS + field_height))
+
+
+def calc_osu_scale(width: int) -> float:
+    """Calculate the size of an osu!pixel on the canvas
+
+        Args:
+            width (int): The pixel width of the canvas.
+
+        Returns:
+            Canvas pixels per osu!pixel.
+    """
+    _, (l, t, r, b) = calc_dimension(width)
+    return max((r - l) / MAX_PLAYFIELD[0], (b - t) / MAX_PLAYFIELD[1])
+
+
+def calc_audio_capture_rate(hop_length: int, sample_rate: int) -> Fraction:
+    """Calculate the capture rate aligned with frames of an audio feature
+
+        Args:
+            hop_length (int): The hop size of the audio frames in samples.
+            sample_rate (int): The sample rate of the audio in Hz.
+
+        Returns:
+            The capture rate in Hz as an exact fraction, so that the i-th
+            snapshot is taken at the start of the i-th audio frame.
+    """
+    return Fraction(sample_rate, hop_length)
+
+
+def calc_interval(capture_rate: Union[int, Rational]) -> Fraction:
+    """Calculate the exact interval between snapshots in ms"""
+    return Fraction(1000) / Fraction(capture_rate)
+
+
+def calc_tick(snapshot_idx: int, interval: Fraction) -> float:
+    """Calculate the time of a snapshot in ms without accumulating error"""
+    # Python integer division is correctly rounded
+    return snapshot_idx * interval.numerator / interval.denominator
+
+
+def calc_num_slice(end_time: timedelta,
+                   capture_rate: Union[int, Rational]) -> int:
+    """Calculate the number of snapshots to cover a beatmap
+
+        Args:
+            end_time (timedelta): The time of the last hit object.
+            capture_rate (int or Fraction): The capture rate in Hz.
+
+        Returns:
+            The number of snapshots, counting exactly in rational time.
+    """
+    seconds = Fraction(end_time // timedelta(microseconds=1), 1000000)
+    return math.floor(seconds * Fraction(capture_rate)) + 2
@@ -0,0 +1,112 @@
+from slider import Beatmap
+from slider.beatmap import Circle, Slider
+from slider.mod import ar_to_ms
+import numpy as np
+import copy
+
+from .slider_process import linearize_batch
+
+
+class BeatmapScene():
+    """Hit objects of a beatmap prepared for rendering
+
+    Args:
+        beatmap (Beatmap): The beatmap to prepare.
+        tolerance (float): The tessellation tolerance of sliders in
+            osu!pixels, see `calc_tolerance`.
+    """
+
+    def __init__(self, beatmap: Beatmap, tolerance: float):
+        self.approach_rate = beatmap.approach_rate
+        self.circle_size = beatmap.circle_size
+        self.lookahead = ar_to_ms(self.approach_rate)
+        self.flip = False
+
+        self.hitcircles = [
+            o for o in beatmap.hit_objects if isinstance(o, Circle)]
+        for circle in self.hitcircles:
+            circle.time_ms = circle.time.total_seconds() * 1000
+        self.hitcircles = sorted(
+            self.hitcircles, key=lambda circle: circle.time_ms)
+
+        self.sliders = [
+            o for o in beatmap.hit_objects if isinstance(o, Slider)]
+        for slider in self.sliders:
+            slider.time_ms = slider.time.total_seconds() * 1000
+            slider.end_ms = slider.end_time.total_seconds() * 1000
+            slider.total_time = slider.end_ms - slider.time_ms
+        self.sliders = sorted(
+            self.sliders, key=lambda slider: slider.time_ms)
+
+        self.vertices, offsets = linearize_batch(
+            [slider.curve for slider in self.sliders],
+            [slider.total_time / slider.repeat for slider in self.sliders],
+            tolerance)
+        for slider, first, last in zip(self.sliders,
+                                       offsets[:-1], offsets[1:]):
+            slider.first = int(first)
+            slider.count = int(last - first)
+
+        self.build_index()
+
+    def with_mods(self, variant):
+        """A view of the scene played with a `ModVariant`
+
+        The view shares hit objects, index and GPU buffers with the scene.
+        Time scaling is not applied here, as snapshots stay in beatmap time
+        and only the capture rate of the variant changes.
+        """
+        scene = copy.copy(self)
+        scene.approach_rate = min(10, self.approach_rate * variant.ar_scale)
+        scene.circle_size = min(10, self.circle_size * variant.cs_scale)
+        scene.lookahead = ar_to_ms(scene.approach_rate)
+        scene.flip = variant.flip
+        return scene
+
+    def build_index(self):
+        self._circle_times = np.array(
+            [circle.time_ms for circle in self.hitcircles], dtype=np.float64)
+        self._slider_times = np.array(
+            [slider.time_ms for slider in self.sliders], dtype=np.float64)
+        # Latest end time among sliders up to each index, non-decreasing
+        # so that the first slider still active can be found by bisection
+        self._slider_reach = np.maximum.accumulate(np.array(
+            [slider.end_ms for slider in self.sliders], dtype=np.float64))
+
+    def query_circles(self, tick):
+        return (int(np.searchsorted(self._circle_times, tick)),
+                int(np.searchsorted(self._circle_times,
+                                    tick + self.lookahead)))
+
+    def query_sliders(self, tick):
+        start = int(np.searchsorted(self._slider_reach, tick))
+        end = int(np.searchsorted(self._slider_times, tick + self.lookahead))
+        return [slider for slider in self.sliders[start:end]
+                if slider.end_ms >= tick]
+
+    def equip(self, gl_backend):
+        self._circle_vaoid = None
+        self._slider_vaoid = None
+        self._circle_vaoid = gl_backend.equip_circles(self.hitcircles)
+        self._slider_vaoid = gl_backend.equip_sliders(self.vertices)
+
+    def release(self, gl_backend):
+        # Geometry of a failed equip is released as far as it was created
+        gl_backend.release_geometry(*[
+            vaoid for vaoid in (self._circle_vaoid, self._slider_vaoid)
+            if vaoid is not None])
+        self._circle_vaoid = None
+        self._slider_vaoid = None
+
+    def draw(self, gl_backend, tick, circle_start, circle_end, sliders):
+        gl_backend.use_geometry(self._circle_vaoid, self._slider_vaoid)
+        gl_backend.set_circle_size(self.circle_size)
+        gl_backend.set_lookahead(self.lookahead)
+        gl_backend.set_flip(self.flip)
+        if circle_end > circle_start:
+            gl_backend.render_circles(tick, circle_start, circle_end)
+
+        if len(sliders) > 0:
+            gl_backend.prepare_sliders(tick)
+            for slider in sliders:
+                gl_backend.render_slider(slider)
@@ -66,10 +66,13 @@ in vec2 texCoord;
 
 // Shaded pixel color
 layout (location = 0) out vec2 color;
+// Coverage by kind of object, discarded unless multichannel
+layout (location = 1) out vec2 kind;
 
 void main() {
     float pct = step(dot(texCoord, texCoord), 1.0f);
     color = vec2(pct * progressF, pct);
+    kind = vec2(pct, 0.0f);
 }
 """
 
@@ -240,6 +243,8 @@ uniform float lookahead;
 in float cumLengthF;
 // Shaded pixel color
 layout (location = 0) out vec2 color;
+// Coverage by kind of object, discarded unless multichannel
+layout (location = 1) out vec2 kind;
 
 void main() {
     float passTime = totalTime / float(repeat);
@@ -255,6 +260,7 @@ void main() {
         appearance -= delta;
         delta = 2 * passTime - delta;
     }
+    kind = vec2(0.0f, color.y);
 }
 """
 
@@ -290,3 +296,22 @@ void main() {
     }
 }
 """
+
+MULTI_AVG_FRAGMENT_SHADER = """#version 440
+// Texture coordinate of the pixel
+in vec2 texCoord;
+// Circle coverage, slider coverage, average progress and overlap count
+out vec4 color;
+
+uniform sampler2D avgSampler;
+uniform sampler2D kindSampler;
+
+void main() {
+    vec4 sum = texture(avgSampler, texCoord);
+    vec4 kind = texture(kindSampler, texCoord);
+    color = vec4(step(0.5f, kind.x), step(0.5f, kind.y), 0.0f, sum.y);
+    if (sum.y > 0.0f) {
+        color.z = sum.x / sum.y;
+    }
+}
+"""
@@ -6,10 +6,9 @@ import itertools
 from slider.curve import *
 
 BEZIER_TOLERANCE = 0.2
+PERFECT_SPACING = 4
+PIXEL_TOLERANCE = 0.25
 CATMULL_REFINEMENT = 20
-CATMULL_SAMPLES = np.linspace(0, 1, CATMULL_REFINEMENT, endpoint=False)
-CATMULL_SAMPLES_2 = CATMULL_SAMPLES * CATMULL_SAMPLES
-CATMULL_SAMPLES_3 = CATMULL_SAMPLES_2 * CATMULL_SAMPLES
 
 
 def bezier_linearize_helper(curve, eps):
@@ -20,91 +19,185 @@ def bezier_linearize_helper(curve, eps):
             bezier_linearize_helper(curve_right, eps))
 
 
-def bezier_linearize(curve):
+def bezier_linearize(curve, tolerance=BEZIER_TOLERANCE):
     if len(curve.points) <= 2:
         return curve.points
     points = np.array(curve.points, dtype=np.double)
     bezier_curve = bezier.Curve.from_nodes(points.T)
     return ([points[0]] +
-            bezier_linearize_helper(bezier_curve, BEZIER_TOLERANCE))
+            bezier_linearize_helper(bezier_curve, tolerance))
 
 
-def perfect_at(curve, t):
-    p_x, p_y = curve.points[0]
-    c_x, c_y = curve._center
-    radians = curve._angle * t
+def linear_linearize(curve):
+    return np.array(curve.points, dtype=np.float32)
 
-    x_dist = p_x - c_x
-    y_dist = p_y - c_y
 
-    cosr = np.cos(radians, dtype=np.float32)
-    sinr = np.sin(radians, dtype=np.float32)
+def multibezier_linearize(curve, tolerance=BEZIER_TOLERANCE):
+    return list(itertools.chain(bezier_linearize(curve._curves[0], tolerance),
+                                *(bezier_linearize(c, tolerance)[1:]
+                                  for c in curve._curves[1:])))
 
-    return np.stack(
-        [(x_dist * cosr - y_dist * sinr) + c_x,
-         (x_dist * sinr + y_dist * cosr) + c_y],
-    ).T
 
+def calc_tolerance(scale, quality=1.0):
+    """Calculate the tessellation tolerance for a canvas resolution
 
-def perfect_linearize(curve):
-    num_points = math.ceil(curve.req_length / 4)
-    return perfect_at(curve, np.linspace(0, 1, num_points))
+    Args:
+        scale (float): Canvas pixels per osu!pixel.
+        quality (float): Multiplier of the tessellation density. Higher is
+            finer, 1 keeps the deviation within PIXEL_TOLERANCE canvas pixels.
 
+    Returns:
+        The maximum deviation of a linearized curve in osu!pixels. Never
+        finer than BEZIER_TOLERANCE unless quality is above 1.
+    """
+    if quality <= 0:
+        raise ValueError('Curve quality must be positive, got %r' % quality)
+    return max(BEZIER_TOLERANCE, PIXEL_TOLERANCE / scale) / quality
 
-def linear_linearize(curve):
-    return np.array(curve.points, dtype=np.float32)
 
+def calc_refinement(tolerance):
+    # The deviation of a polyline from a smooth curve falls with the square
+    # of its step, so steps scale with the square root of the tolerance
+    return math.sqrt(tolerance / BEZIER_TOLERANCE)
 
-def multibezier_linearize(curve):
-    return list(itertools.chain(bezier_linearize(curve._curves[0]),
-                                *(bezier_linearize(c)[1:]
-                                  for c in curve._curves[1:])))
 
+def perfect_linearize_batch(curves, tolerance=BEZIER_TOLERANCE):
+    spacing = PERFECT_SPACING * calc_refinement(tolerance)
+    num_points = np.array([max(2, math.ceil(curve.req_length / spacing))
+                           for curve in curves], dtype=np.int64)
+    curve_idx = np.repeat(np.arange(len(curves)), num_points)
+    first_idx = np.cumsum(num_points) - num_points
+    local_idx = np.arange(curve_idx.shape[0]) - first_idx[curve_idx]
+
+    # Same arithmetic as np.linspace(0, 1, num_points) for each curve
+    step = 1.0 / np.maximum(num_points - 1, 1)
+    t = local_idx * step[curve_idx]
+    t[(first_idx + num_points - 1)[num_points > 1]] = 1.0
+
+    starts = np.array([curve.points[0] for curve in curves],
+                      dtype=np.double)
+    centers = np.array([curve._center for curve in curves], dtype=np.double)
+    angles = np.array([curve._angle for curve in curves], dtype=np.double)
+    radians = angles[curve_idx] * t
+
+    x_dist, y_dist = (starts - centers)[curve_idx].T
+    c_x, c_y = centers[curve_idx].T
+
+    cosr = np.cos(radians, dtype=np.float32)
+    sinr = np.sin(radians, dtype=np.float32)
 
-def catmull_linearize(curve):
-    to_expand = np.array(curve.points[-2:])
-    expanded = to_expand[1] + to_expand[1] - to_expand[0]
-    raw_points = list(itertools.chain(
-        [curve.points[0]], curve.points, [expanded]))
-    points = np.array(raw_points, dtype=np.float32)
-    shape = (2, points.shape[0] - 3, 4)
-    strides = (points.itemsize, 2 * points.itemsize, 2 * points.itemsize)
-    catmull_pieces = np.lib.stride_tricks.as_strided(
-        points, shape=shape, strides=strides)
-    steps, idx = np.meshgrid(CATMULL_SAMPLES, np.arange(shape[1]))
+    points = np.stack(
+        [(x_dist * cosr - y_dist * sinr) + c_x,
+         (x_dist * sinr + y_dist * cosr) + c_y],
+    ).T
+    return np.split(points, np.cumsum(num_points)[:-1])
+
+
+def catmull_linearize_batch(curves, tolerance=BEZIER_TOLERANCE):
+    refinement = max(2, math.ceil(CATMULL_REFINEMENT /
+                                  calc_refinement(tolerance)))
+    samples = np.linspace(0, 1, refinement, endpoint=False)[:, np.newaxis]
+
+    padded = []
+    for curve in curves:
+        to_expand = np.array(curve.points[-2:])
+        expanded = to_expand[1] + to_expand[1] - to_expand[0]
+        padded.append(np.array(list(itertools.chain(
+            [curve.points[0]], curve.points, [expanded])), dtype=np.float32))
+    num_segments = np.array([p.shape[0] - 3 for p in padded], dtype=np.int64)
+    padded_offsets = np.cumsum([0] + [p.shape[0] for p in padded[:-1]])
+    segment_start = (np.repeat(padded_offsets, num_segments) +
+                     np.arange(num_segments.sum()) -
+                     np.repeat(np.cumsum(num_segments) - num_segments,
+                               num_segments))
+
+    points = np.concatenate(padded)
+    p0, p1, p2, p3 = (points[segment_start + i][:, np.newaxis, :]
+                      for i in range(4))
+    steps = samples
+    steps_2 = samples * samples
+    steps_3 = steps_2 * samples
     result_grid = (0.5 *
-                   (2 * catmull_pieces[:, idx, 1] +
-                    steps * (catmull_pieces[:, idx, 2] -
-                             catmull_pieces[:, idx, 0]) +
-                    CATMULL_SAMPLES_2 * (2 * catmull_pieces[:, idx, 0] -
-                                         5 * catmull_pieces[:, idx, 1] +
-                                         4 * catmull_pieces[:, idx, 2] -
-                                         catmull_pieces[:, idx, 3]) +
-                    CATMULL_SAMPLES_3 * (-catmull_pieces[:, idx, 0] +
-                                         3 * catmull_pieces[:, idx, 1] -
-                                         3 * catmull_pieces[:, idx, 2] +
-                                         catmull_pieces[:, idx, 3])))
-    return result_grid.reshape((2, shape[1] * CATMULL_REFINEMENT)).T
-
-
-def linearize(curve, time_scale):
-    if isinstance(curve, Bezier):
-        points = np.array(bezier_linearize(curve), dtype=np.float32)
-    elif isinstance(curve, Perfect):
-        points = perfect_linearize(curve)
-    elif isinstance(curve, Linear):
-        points = linear_linearize(curve)
-    elif isinstance(curve, MultiBezier):
-        points = np.array(multibezier_linearize(curve), dtype=np.float32)
-    elif isinstance(curve, Catmull):
-        points = catmull_linearize(curve)
-
-    vectors = np.diff(points, axis=0)
-    output = np.empty((points.shape[0] + 2, 3), dtype=np.float32)
-    output[1:-1, 0:2] = points
-    distance = np.linalg.norm(vectors, ord=2, axis=1)
-    np.cumsum(distance, out=output[2:-1, 2])
-    output[1, 2] = 0
-    output[0], output[-1] = output[1], output[-2]
-    output[:, 2] *= time_scale / output[-1, 2]
-    return output
+                   (2 * p1 +
+                    steps * (p2 - p0) +
+                    steps_2 * (2 * p0 - 5 * p1 + 4 * p2 - p3) +
+                    steps_3 * (-p0 + 3 * p1 - 3 * p2 + p3)))
+    result = result_grid.reshape((-1, 2))
+    return np.split(result,
+                    np.cumsum(num_segments * refinement)[:-1])
+
+
+def linearize_points(curves, tolerance):
+    points = [None] * len(curves)
+    batched = {Perfect: perfect_linearize_batch,
+               Catmull: catmull_linearize_batch}
+    for curve_type, linearize_group in batched.items():
+        indices = [i for i, curve in enumerate(curves)
+                   if isinstance(curve, curve_type)]
+        if len(indices) > 0:
+            group = linearize_group([curves[i] for i in indices], tolerance)
+            for i, group_points in zip(indices, group):
+                points[i] = group_points
+
+    for i, curve in enumerate(curves):
+        if isinstance(curve, Bezier):
+            points[i] = np.array(bezier_linearize(curve, tolerance),
+                                 dtype=np.float32)
+        elif isinstance(curve, Linear):
+            points[i] = linear_linearize(curve)
+        elif isinstance(curve, MultiBezier):
+            points[i] = np.array(multibezier_linearize(curve, tolerance),
+                                 dtype=np.float32)
+    return points
+
+
+def linearize_batch(curves, time_scales, tolerance=BEZIER_TOLERANCE):
+    """Linearize many slider curves at once
+
+    Args:
+        curves (List[Curve]): The curves of the sliders.
+        time_scales (List[float]): The duration of one pass of each slider
+            in ms, which the cumulative length is scaled to.
+        tolerance (float): The maximum deviation from the curves in
+            osu!pixels, see `calc_tolerance`.
+
+    Returns:
+        A tuple of a float32 vertex array of shape (n, 3) and an int64
+        array of len(curves) + 1 offsets. Vertices of the i-th curve are
+        vertices[offsets[i]:offsets[i + 1]], laid out as by `linearize`.
+    """
+    points = linearize_points(curves, tolerance)
+    num_points = np.array([p.shape[0] for p in points], dtype=np.int64)
+    offsets = np.zeros(len(curves) + 1, dtype=np.int64)
+    np.cumsum(num_points + 2, out=offsets[1:])
+    if len(curves) == 0:
+        return np.empty((0, 3), dtype=np.float32), offsets
+
+    flat = np.concatenate(points).astype(np.float32, copy=False)
+    curve_idx = np.repeat(np.arange(len(curves)), num_points)
+    first_point = np.cumsum(num_points) - num_points
+
+    # Lengths between consecutive points, zeroed across curve boundaries
+    distance = np.zeros(flat.shape[0], dtype=np.float64)
+    distance[1:] = np.linalg.norm(np.diff(flat, axis=0), ord=2, axis=1)
+    distance[first_point] = 0
+    cum_length = np.cumsum(distance)
+    cum_length -= cum_length[first_point][curve_idx]
+    total_length = cum_length[first_point + num_points - 1]
+    scale = np.divide(np.asarray(time_scales, dtype=np.float64),
+                      total_length,
+                      out=np.zeros(len(curves), dtype=np.float64),
+                      where=total_length > 0)
+
+    output = np.empty((offsets[-1], 3), dtype=np.float32)
+    rows = np.arange(flat.shape[0]) + 2 * curve_idx + 1
+    output[rows, 0:2] = flat
+    output[rows, 2] = cum_length * scale[curve_idx]
+    output[offsets[:-1]] = output[offsets[:-1] + 1]
+    output[offsets[1:] - 1] = output[offsets[1:] - 2]
+    return output, offsets
+
+
+def linearize(curve, time_scale, tolerance=BEZIER_TOLERANCE):
+    vertices, _ = linearize_batch([curve], [time_scale], tolerance)
+    return vertices
@@ -1,73 +1,391 @@
 from slider import Beatmap
-from slider.beatmap import Circle, Slider
+from slider.beatmap import Slider, HitObject
 from slider.mod import ar_to_ms
+from fractions import Fraction
+from numbers import Rational
+from typing import List, Optional, Tuple, Union
 import numpy as np
 import math
 import threading
 import heapq
 import itertools
 
-from .gl_backend import GLBackend
-from .parameter_convert import calc_dimension
-from .slider_process import linearize
+from .gl_backend import (CHANNELS, DEFAULT_FRAMES_IN_FLIGHT, GLBackend,
+                         query_hardware_devices)
+from .parameter_convert import (calc_dimension, calc_interval, calc_tick,
+                                calc_num_slice, calc_osu_scale)
+from .scene import BeatmapScene
+from .slider_process import calc_tolerance
+from .structs import SnapshotEstimate
 
 
 def make_snapshots(beatmap: Beatmap,
                    target_width: int,
-                   capture_rate: int) -> np.ndarray:
+                   capture_rate: Union[int, Rational],
+                   device: Optional[int] = None,
+                   curve_quality: float = 1.0,
+                   max_tile_size: Optional[int] = None,
+                   mods: Optional[List[str]] = None,
+                   multichannel: bool = False,
+                   frames_in_flight: int = DEFAULT_FRAMES_IN_FLIGHT
+                   ) -> Union[np.ndarray, List[np.ndarray]]:
     """Make snapshots of a beatmap
     Args:
         beatmap (Beatmap): The beatmap to process.
         target_width (int): The pixel width of desired output.
-        capture_rate (int): The capture rate of the snapshots in Hz
+        capture_rate (int or Fraction): The capture rate of the snapshots
+            in Hz. A Fraction, e.g. from `calc_audio_capture_rate`, gives
+            ticks exactly aligned with audio frames.
+        device (int): Index of the EGL device to render on. Defaults to
+            the default display.
+        curve_quality (float): Density of slider tessellation relative to
+            the output resolution, see `calc_tolerance`.
+        max_tile_size (int): Largest framebuffer side in pixels. Canvases
+            beyond it, or beyond the limits of the driver, are rendered
+            tile by tile into the output.
+        mods (List[str]): Mod combinations like ['NM', 'DT', 'HR'] to
+            render from the same preprocessing pass, see
+            `make_mod_snapshots`. The capture rate is then in playback time.
+        multichannel (bool): Write the channels in `CHANNELS` separately in
+            the same render pass: circle coverage, slider coverage, average
+            approach progress and raw overlap count.
+        frames_in_flight (int): Number of snapshots queued on the GPU
+            before the oldest is read back. More hide more readback
+            latency, at the cost of one framebuffer sized buffer each.
     Returns:
         Snapshots of the beatmap. A numpy array of size
         target_width x floor(target_width * 16 / 9)
         x 2 x (length_of_beatmap x capture_rate)
+        With `multichannel`, the channel axis follows the time axis.
+        With `mods`, a list of such arrays instead, one for each mod
+        combination in the same order, as returned by `make_mod_snapshots`.
     """
+    if mods is not None:
+        from .atlas import make_mod_snapshots
+        return make_mod_snapshots(beatmap, target_width, capture_rate, mods,
+                                  device=device, curve_quality=curve_quality,
+                                  multichannel=multichannel,
+                                  max_tile_size=max_tile_size,
+                                  frames_in_flight=frames_in_flight)
     result = SnapshotThread.create_buffer(beatmap,
                                           target_width,
-                                          capture_rate)
-    processor = SnapshotThread(beatmap, target_width, capture_rate, result)
+                                          capture_rate,
+                                          multichannel=multichannel)
+    processor = SnapshotThread(beatmap, target_width, capture_rate, result,
+                               device=device, curve_quality=curve_quality,
+                               max_tile_size=max_tile_size,
+                               frames_in_flight=frames_in_flight,
+                               multichannel=multichannel)
     processor.start()
     processor.join()
     return result
 
 
+def make_snapshots_at(beatmap: Beatmap,
+                      target_width: int,
+                      ticks: np.ndarray,
+                      device: Optional[int] = None,
+                      curve_quality: float = 1.0,
+                      multichannel: bool = False,
+                      max_tile_size: Optional[int] = None,
+                      frames_in_flight: int = DEFAULT_FRAMES_IN_FLIGHT
+                      ) -> np.ndarray:
+    """Make snapshots of a beatmap at arbitrary timestamps
+    Args:
+        beatmap (Beatmap): The beatmap to process.
+        target_width (int): The pixel width of desired output.
+        ticks (np.ndarray): Timestamps in ms to capture, in any order.
+        device (int): Index of the EGL device to render on. Defaults to
+            the default display.
+        curve_quality (float): Density of slider tessellation relative to
+            the output resolution, see `calc_tolerance`.
+        multichannel (bool): Write separate channels, see `make_snapshots`.
+        max_tile_size (int): Largest framebuffer side in pixels, see
+            `make_snapshots`.
+        frames_in_flight (int): Number of snapshots queued on the GPU
+            before the oldest is read back, see `make_snapshots`.
+    Returns:
+        Snapshots of the beatmap. A numpy array of size
+        len(ticks) x target_width x floor(target_width * 16 / 9),
+        where the i-th snapshot is taken at ticks[i]
+    """
+    ticks = np.asarray(ticks, dtype=np.float64).reshape(-1)
+    (w, h), _ = calc_dimension(target_width)
+    shape = ((ticks.shape[0], len(CHANNELS), w, h) if multichannel
+             else (ticks.shape[0], w, h))
+    result = np.zeros(shape, dtype=np.float32)
+    processor = SnapshotThread(beatmap, target_width, None, result,
+                               device=device, ticks=ticks,
+                               curve_quality=curve_quality,
+                               multichannel=multichannel,
+                               max_tile_size=max_tile_size,
+                               frames_in_flight=frames_in_flight)
+    # Render on this thread, so that errors reach the caller
+    processor.run()
+    return result
+
+
+def make_snapshots_multi(beatmaps: List[Beatmap],
+                         target_width: int,
+                         capture_rate: Union[int, Rational],
+                         devices: Optional[List[int]] = None,
+                         curve_quality: float = 1.0,
+                         multichannel: bool = False,
+                         max_tile_size: Optional[int] = None,
+                         frames_in_flight: int = DEFAULT_FRAMES_IN_FLIGHT
+                         ) -> List[np.ndarray]:
+    """Make snapshots of several beatmaps across all available GPUs
+    Args:
+        beatmaps (List[Beatmap]): The beatmaps to process.
+        target_width (int): The pixel width of desired output.
+        capture_rate (int or Fraction): The capture rate of the snapshots
+            in Hz. A Fraction, e.g. from `calc_audio_capture_rate`, gives
+            ticks exactly aligned with audio frames.
+        devices (List[int]): Indices of the EGL devices to render on.
+            Defaults to every enumerable device except software
+            rasterizers, which are only used when there is no other, or
+            the default display if devices cannot be enumerated. List a
+            software device explicitly to render on it as well.
+        curve_quality (float): Density of slider tessellation relative to
+            the output resolution, see `calc_tolerance`.
+        multichannel (bool): Write separate channels, see `make_snapshots`.
+        max_tile_size (int): Largest framebuffer side in pixels, see
+            `make_snapshots`.
+        frames_in_flight (int): Number of snapshots queued on the GPU
+            before the oldest is read back, see `make_snapshots`.
+    Returns:
+        A list of snapshots, one for each beatmap in the same order, each
+        as returned by `make_snapshots`. Beatmaps are assigned to devices
+        round-robin and each device renders its share sequentially.
+        The first error raised by a device is raised here.
+    """
+    if devices is None:
+        devices = query_hardware_devices()
+    # One worker per device, a device listed twice would only add contention
+    devices = list(dict.fromkeys(devices))
+    if len(devices) == 0:
+        devices = [None]
+
+    results = [SnapshotThread.create_buffer(beatmap,
+                                            target_width,
+                                            capture_rate,
+                                            multichannel=multichannel)
+               for beatmap in beatmaps]
+    processors = [SnapshotThread(beatmap, target_width, capture_rate, result,
+                                 device=devices[i % len(devices)],
+                                 curve_quality=curve_quality,
+                                 multichannel=multichannel,
+                                 max_tile_size=max_tile_size,
+                                 frames_in_flight=frames_in_flight)
+                  for i, (beatmap, result) in enumerate(zip(beatmaps,
+                                                            results))]
+    errors = []
+    workers = [threading.Thread(target=run_sequentially,
+                                args=(processors[i::len(devices)], errors))
+               for i in range(len(devices))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if len(errors) > 0:
+        raise errors[0]
+    return results
+
+
+def update_snapshots(beatmap: Beatmap,
+                     result: np.ndarray,
+                     target_width: int,
+                     capture_rate: Union[int, Rational],
+                     time_range: Optional[Tuple[float, float]] = None,
+                     hit_objects: Optional[List[HitObject]] = None,
+                     device: Optional[int] = None,
+                     curve_quality: float = 1.0,
+                     max_tile_size: Optional[int] = None,
+                     frames_in_flight: int = DEFAULT_FRAMES_IN_FLIGHT
+                     ) -> np.ndarray:
+    """Re-render the part of existing snapshots affected by an edit
+    Args:
+        beatmap (Beatmap): The edited beatmap.
+        result (np.ndarray): Snapshots of the beatmap before the edit, as
+            returned by `make_snapshots` with the same target_width and
+            capture_rate, and with multichannel if it has a channel axis.
+            Updated in place.
+        target_width (int): The pixel width of desired output.
+        capture_rate (int or Fraction): The capture rate of the snapshots
+            in Hz. A Fraction, e.g. from `calc_audio_capture_rate`, gives
+            ticks exactly aligned with audio frames.
+        time_range (Tuple[float, float]): Start and end in ms of a time
+            range to re-render.
+        hit_objects (List[HitObject]): Hit objects that changed. A tick is
+            affected if the object is within lookahead of its start through
+            to its end. For a moved or removed object, pass the version
+            before the edit as well.
+        device (int): Index of the EGL device to render on. Defaults to
+            the default display.
+        curve_quality (float): Density of slider tessellation relative to
+            the output resolution, see `calc_tolerance`.
+        max_tile_size (int): Largest framebuffer side in pixels, see
+            `make_snapshots`.
+        frames_in_flight (int): Number of snapshots queued on the GPU
+            before the oldest is read back, see `make_snapshots`.
+    Returns:
+        The updated snapshots, i.e. result. Edits to approach rate or
+        circle size affect every tick and need a full `make_snapshots`.
+        Errors while rendering are raised here, the affected frames of
+        result are then undefined.
+    """
+    multichannel = result.ndim == 4
+    shape = SnapshotThread.buffer_shape(beatmap, target_width, capture_rate,
+                                        multichannel=multichannel)
+    if result.shape != shape:
+        raise ValueError('Snapshots of shape %s do not match the beatmap, '
+                         'expected %s' % (result.shape, shape))
+
+    interval = calc_interval(capture_rate)
+    lookahead = ar_to_ms(beatmap.approach_rate)
+    ranges = []
+    if time_range is not None:
+        ranges.append(time_range)
+    for o in hit_objects or []:
+        end_time = o.end_time if isinstance(o, Slider) else o.time
+        ranges.append((o.time.total_seconds() * 1000 - lookahead,
+                       end_time.total_seconds() * 1000))
+
+    windows = []
+    for start_ms, end_ms in sorted(ranges):
+        # float first, Fraction rejects numpy scalars
+        first = max(0, math.floor(Fraction(float(start_ms)) / interval))
+        last = min(shape[0],
+                   math.floor(Fraction(float(end_ms)) / interval) + 1)
+        if first >= last:
+            continue
+        if len(windows) > 0 and first <= windows[-1][1]:
+            windows[-1] = (windows[-1][0], max(windows[-1][1], last))
+        else:
+            windows.append((first, last))
+
+    if len(windows) > 0:
+        processor = SnapshotThread(beatmap, target_width, capture_rate,
+                                   result, device=device, windows=windows,
+                                   curve_quality=curve_quality,
+                                   multichannel=multichannel,
+                                   max_tile_size=max_tile_size,
+                                   frames_in_flight=frames_in_flight)
+        # Render on this thread, so that a failure reaches the caller
+        # instead of leaving cleared frames in result unnoticed
+        processor.run()
+    return result
+
+
+def estimate_snapshots(beatmap: Beatmap,
+                       target_width: int,
+                       capture_rate: Union[int, Rational],
+                       curve_quality: float = 1.0,
+                       multichannel: bool = False) -> SnapshotEstimate:
+    """Estimate the cost of making snapshots of a beatmap without rendering
+    Args:
+        beatmap (Beatmap): The beatmap to process.
+        target_width (int): The pixel width of desired output.
+        capture_rate (int or Fraction): The capture rate of the snapshots
+            in Hz.
+        curve_quality (float): Density of slider tessellation relative to
+            the output resolution, see `calc_tolerance`.
+        multichannel (bool): Write separate channels, see `make_snapshots`.
+    Returns:
+        A `SnapshotEstimate` with the shape and byte size of the output of
+        `make_snapshots`, the number of frames with any object to draw,
+        the number of slider vertices after linearization and the largest
+        number of objects drawn in one frame. Render time grows with the
+        non-empty frames, each drawing up to peak_objects objects.
+    """
+    shape = SnapshotThread.buffer_shape(beatmap, target_width, capture_rate,
+                                        multichannel=multichannel)
+    scene = BeatmapScene(beatmap,
+                         calc_tolerance(calc_osu_scale(target_width),
+                                        curve_quality))
+    interval = calc_interval(capture_rate)
+    ticks = np.array([calc_tick(snapshot_idx, interval)
+                      for snapshot_idx in range(shape[0])])
+
+    # An object is drawn from lookahead before its start through its end,
+    # as maintained by update_circle_pool and update_slider_pool
+    starts = np.array([o.time_ms for o in scene.hitcircles] +
+                      [o.time_ms for o in scene.sliders]) - scene.lookahead
+    ends = np.array([o.time_ms for o in scene.hitcircles] +
+                    [o.end_ms for o in scene.sliders])
+    active = np.zeros(shape[0] + 1, dtype=np.int64)
+    np.add.at(active, np.searchsorted(ticks, starts, side='right'), 1)
+    np.add.at(active, np.searchsorted(ticks, ends, side='right'), -1)
+    active = np.cumsum(active[:-1])
+
+    return SnapshotEstimate(
+        shape=shape,
+        nbytes=int(np.prod(shape)) * np.dtype(np.float32).itemsize,
+        nonempty_frames=int(np.count_nonzero(active)),
+        slider_vertices=len(scene.vertices),
+        peak_objects=int(active.max(initial=0)))
+
+
+def run_sequentially(processors, errors):
+    try:
+        for processor in processors:
+            processor.run()
+    except Exception as e:
+        errors.append(e)
+
+
 class SnapshotThread(threading.Thread):
-    def __init__(self, beatmap, target_width, capture_rate, result):
+    def __init__(self, beatmap, target_width, capture_rate, result,
+                 device=None, windows=None, ticks=None, curve_quality=1.0,
+                 max_tile_size=None, multichannel=False, progress=None,
+                 frames_in_flight=DEFAULT_FRAMES_IN_FLIGHT):
         super().__init__()
         self._beatmap = beatmap
         self._target_width = target_width
-        self._interval = 1000 / capture_rate
+        self._interval = (None if capture_rate is None
+                          else calc_interval(capture_rate))
+        self._ticks = ticks
+        self._curve_quality = curve_quality
+        self._max_tile_size = max_tile_size
+        self._frames_in_flight = frames_in_flight
+        self._multichannel = multichannel
+        self._progress = progress
         self._lookahead = ar_to_ms(self._beatmap.approach_rate)
         self._result = result
+        self._device = device
+        self._windows = windows or [(0, result.shape[0])]
 
     def run(self):
         gl_backend = GLBackend(
-            self._target_width, self._beatmap.circle_size, self._lookahead)
-
-        self._hitcircles = [
-            o for o in self._beatmap.hit_objects if isinstance(o, Circle)]
-        for circle in self._hitcircles:
-            circle.time_ms = circle.time.total_seconds() * 1000
-        self._hitcircles = sorted(
-            self._hitcircles, key=lambda circle: circle.time_ms)
-
-        self._sliders = [
-            o for o in self._beatmap.hit_objects if isinstance(o, Slider)]
-        for slider in self._sliders:
-            slider.time_ms = slider.time.total_seconds() * 1000
-            slider.end_ms = slider.end_time.total_seconds() * 1000
-            slider.total_time = slider.end_ms - slider.time_ms
-            slider.linearization = linearize(slider.curve,
-                                             slider.total_time / slider.repeat)
-        self._sliders = sorted(
-            self._sliders, key=lambda slider: slider.time_ms)
-
-        gl_backend.equip_circles(self._hitcircles)
-        self.make_snapshots(gl_backend)
-        gl_backend.destroy()
+            self._target_width, self._beatmap.circle_size, self._lookahead,
+            device=self._device, max_tile_size=self._max_tile_size,
+            frames_in_flight=self._frames_in_flight,
+            multichannel=self._multichannel)
+        try:
+            self.render(gl_backend)
+        finally:
+            gl_backend.destroy()
+
+    def render(self, gl_backend):
+        """Render with an existing backend
+
+            Must be called on the thread owning the context of the backend,
+            which is left ready for further renders.
+        """
+        self._scene = BeatmapScene(
+            self._beatmap,
+            calc_tolerance(gl_backend.osu_scale, self._curve_quality))
+        self._hitcircles = self._scene.hitcircles
+        self._sliders = self._scene.sliders
+
+        try:
+            self._scene.equip(gl_backend)
+            if self._ticks is None:
+                self.make_snapshots(gl_backend)
+            else:
+                self.make_snapshots_at(gl_backend)
+        finally:
+            self._scene.release(gl_backend)
 
     def make_snapshots(self, gl_backend):
         circle_start = 0
@@ -77,27 +395,58 @@ class SnapshotThread(threading.Thread):
         slider_counter = itertools.count()
         slider_pool = []
 
-        num_slice = self._result.shape[0]
+        for first, last in self._windows:
+            self._result[first:last] = 0
 
-        for snapshot_idx in range(num_slice):
-            tick = snapshot_idx * self._interval
+        total = sum(last - first for first, last in self._windows)
+        for done, snapshot_idx in enumerate(itertools.chain(
+                *(range(first, last) for first, last in self._windows))):
+            tick = calc_tick(snapshot_idx, self._interval)
+            if self._progress is not None:
+                self._progress(done, total)
 
             circle_start, circle_end = self.update_circle_pool(
                 tick, circle_start, circle_end)
 
             slider_start = self.update_slider_pool(
-                tick, slider_start, slider_pool, gl_backend, slider_counter)
+                tick, slider_start, slider_pool, slider_counter)
+
+            self.render_tick(gl_backend, snapshot_idx, tick,
+                             circle_start, circle_end,
+                             [slider for _, _, slider in slider_pool])
+
+        for ready in gl_backend.flush():
+            self.store(ready)
 
-            if circle_end > circle_start or len(slider_pool) > 0:
+    def make_snapshots_at(self, gl_backend):
+        for snapshot_idx, tick in enumerate(self._ticks.tolist()):
+            if self._progress is not None:
+                self._progress(snapshot_idx, len(self._ticks))
+            circle_start, circle_end = self._scene.query_circles(tick)
+            sliders = self._scene.query_sliders(tick)
+            self.render_tick(gl_backend, snapshot_idx, tick,
+                             circle_start, circle_end, sliders)
+
+        for ready in gl_backend.flush():
+            self.store(ready)
+
+    def render_tick(self, gl_backend, snapshot_idx, tick,
+                    circle_start, circle_end, sliders):
+        if circle_end > circle_start or len(sliders) > 0:
+            for tile_idx, tile in enumerate(gl_backend.tiles):
+                gl_backend.set_tile(tile_idx)
                 gl_backend.setup()
-                if circle_end > circle_start:
-                    gl_backend.render_circles(tick, circle_start, circle_end)
+                self._scene.draw(gl_backend, tick, circle_start, circle_end,
+                                 sliders)
+                self.store(gl_backend.calc_avg((snapshot_idx, tile)))
 
-                if len(slider_pool) > 0:
-                    gl_backend.prepare_sliders(tick)
-                    for _, _, slider in slider_pool:
-                        gl_backend.render_slider(slider)
-                self._result[snapshot_idx] = gl_backend.calc_avg()
+    def store(self, ready):
+        if ready is not None:
+            (snapshot_idx, tile), frame = ready
+            self._result[snapshot_idx, ...,
+                         tile.left:tile.right,
+                         tile.top:tile.bottom] = \
+                frame[..., :tile.right - tile.left, :tile.bottom - tile.top]
 
     def update_circle_pool(self, tick, start, end):
         while (end < len(self._hitcircles) and
@@ -116,36 +465,36 @@ class SnapshotThread(threading.Thread):
                            tick,
                            start,
                            slider_pool,
-                           gl_backend,
                            counter):
-        joined_sliders = []
-        retired_sliders = []
         while (start < len(self._sliders) and
                self._sliders[start].time_ms <
                tick + self._lookahead):
             slider = self._sliders[start]
             heapq.heappush(slider_pool, (slider.end_ms, next(counter), slider))
-            joined_sliders.append(slider)
             start += 1
 
         while len(slider_pool) > 0 and slider_pool[0][0] < tick:
-            _, _, slider = heapq.heappop(slider_pool)
-            retired_sliders.append(slider)
-
-        if len(joined_sliders) > 0:
-            gl_backend.equip_sliders(joined_sliders)
-
-        if len(retired_sliders) > 0:
-            gl_backend.unequip_sliders(retired_sliders)
+            heapq.heappop(slider_pool)
 
         return start
 
     @staticmethod
-    def create_buffer(beatmap, target_width, capture_rate):
+    def buffer_shape(beatmap, target_width, capture_rate,
+                     multichannel=False):
         (w, h), _ = calc_dimension(target_width)
         end_time = max(beatmap.hit_objects,
                        key=lambda o: (o.end_time
                                       if isinstance(o, Slider) else o.time))
-        num_slice = math.floor(
-            end_time.time.total_seconds() * capture_rate) + 2
-        return np.zeros((num_slice, w, h), dtype=np.float32)
+        num_slice = calc_num_slice(end_time.time, capture_rate)
+        if multichannel:
+            return (num_slice, len(CHANNELS), w, h)
+        return (num_slice, w, h)
+
+    @staticmethod
+    def create_buffer(beatmap, target_width, capture_rate,
+                      multichannel=False):
+        return np.zeros(SnapshotThread.buffer_shape(beatmap,
+                                                    target_width,
+                                                    capture_rate,
+                                                    multichannel),
+                        dtype=np.float32)
@@ -0,0 +1,432 @@
+from slider import Beatmap
+from numbers import Rational
+from typing import Optional, Tuple, Union
+import numpy as np
+import abc
+import json
+import operator
+import os
+import struct
+import threading
+import zlib
+
+from .gl_backend import DEFAULT_FRAMES_IN_FLIGHT
+from .snapshot import SnapshotThread
+
+__all__ = [
+    'ChunkedSink',
+    'HandoverSink',
+    'RenderCancelled',
+    'SnapshotReader',
+    'SnapshotWriter',
+    'write_snapshots'
+]
+
+MAGIC = b'BMSNAP1\0'
+FOOTER = struct.Struct('<Q8s')
+DEFAULT_CHUNK_FRAMES = 64
+DEFAULT_MAX_CHUNKS = 4
+CODECS = ['none', 'zlib', 'zstd']
+
+
+def write_snapshots(path: str,
+                    beatmap: Beatmap,
+                    target_width: int,
+                    capture_rate: Union[int, Rational],
+                    device: Optional[int] = None,
+                    curve_quality: float = 1.0,
+                    multichannel: bool = False,
+                    max_tile_size: Optional[int] = None,
+                    frames_in_flight: int = DEFAULT_FRAMES_IN_FLIGHT,
+                    chunk_frames: int = DEFAULT_CHUNK_FRAMES,
+                    codec: str = 'zlib',
+                    delta: bool = True) -> Tuple[int, ...]:
+    """Make snapshots of a beatmap straight into a compressed file
+    Args:
+        path (str): The file to write.
+        beatmap (Beatmap): The beatmap to process.
+        target_width (int): The pixel width of desired output.
+        capture_rate (int or Fraction): The capture rate of the snapshots
+            in Hz.
+        device (int): Index of the EGL device to render on. Defaults to
+            the default display.
+        curve_quality (float): Density of slider tessellation relative to
+            the output resolution, see `calc_tolerance`.
+        multichannel (bool): Write separate channels, see `make_snapshots`.
+        max_tile_size (int): Largest framebuffer side in pixels, see
+            `make_snapshots`.
+        frames_in_flight (int): Number of snapshots queued on the GPU
+            before the oldest is read back, see `make_snapshots`.
+        chunk_frames (int): Number of frames compressed together.
+        codec (str): One of `CODECS`. zstd needs the zstandard package.
+        delta (bool): Encode each frame against the previous one within
+            its chunk.
+    Returns:
+        The shape of the snapshots, as `make_snapshots` would return. Only
+        one chunk is held in memory at a time, read the file back with
+        `SnapshotReader`.
+    """
+    shape = SnapshotThread.buffer_shape(beatmap, target_width, capture_rate,
+                                        multichannel=multichannel)
+    with SnapshotWriter(path, shape, chunk_frames=chunk_frames,
+                        codec=codec, delta=delta) as writer:
+        processor = SnapshotThread(beatmap, target_width, capture_rate,
+                                   writer, device=device,
+                                   curve_quality=curve_quality,
+                                   multichannel=multichannel,
+                                   max_tile_size=max_tile_size,
+                                   frames_in_flight=frames_in_flight)
+        # Render on this thread, so that a failure removes the partial file
+        processor.run()
+    return shape
+
+
+def get_codec(codec):
+    if codec == 'none':
+        return bytes, bytes
+    if codec == 'zlib':
+        return (lambda data: zlib.compress(data, 1)), zlib.decompress
+    if codec == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('Codec zstd needs the zstandard package')
+        return (zstandard.ZstdCompressor().compress,
+                zstandard.ZstdDecompressor().decompress)
+    raise ValueError('Unknown codec %r, expected one of %s' %
+                     (codec, ', '.join(CODECS)))
+
+
+def encode_chunk(chunk, delta):
+    words = np.ascontiguousarray(chunk, dtype=np.float32).view(
+        np.uint32).reshape(chunk.shape[0], -1)
+    if delta:
+        # XOR keeps the encoding exact, and unchanged pixels become zero
+        words = np.concatenate(
+            (words[:1], np.bitwise_xor(words[1:], words[:-1])))
+    # Files are little-endian whatever the machine. Group bytes by
+    # significance so that the compressor sees long runs
+    return words.astype('<u4', copy=False).view(np.uint8).reshape(
+        -1, 4).T.tobytes()
+
+
+def decode_chunk(data, shape, delta):
+    planes = np.frombuffer(data, dtype=np.uint8).reshape(4, -1)
+    words = np.ascontiguousarray(planes.T).view('<u4').astype(
+        np.uint32, copy=False).reshape(shape[0], -1)
+    if delta:
+        np.bitwise_xor.accumulate(words, axis=0, out=words)
+    return words.view(np.float32).reshape(shape)
+
+
+class ChunkedSink(abc.ABC):
+    """Receive snapshots frame by frame and pass them on in chunks
+
+    A sink stands in for the snapshot array of `SnapshotThread`. Frames
+    must be written in order, frames never written are zero. Subclasses
+    implement `emit`, which gets every chunk once it is complete.
+
+    Args:
+        shape (Tuple[int]): Shape of the snapshots, frames first.
+        chunk_frames (int): Number of frames in a chunk.
+    """
+
+    def __init__(self, shape, chunk_frames=DEFAULT_CHUNK_FRAMES):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(np.float32)
+        self._chunk_frames = chunk_frames
+        self._chunk_start = 0
+        self._chunk = np.zeros((chunk_frames,) + self.shape[1:],
+                               dtype=np.float32)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __setitem__(self, key, value):
+        rest = ()
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+        if isinstance(key, slice):
+            indices = range(*key.indices(self.shape[0]))
+        else:
+            idx = operator.index(key)
+            indices = range(idx, idx + 1)
+            value = np.expand_dims(value, 0)
+        if len(indices) > 0 and not (0 <= min(indices[0], indices[-1]) and
+                                     max(indices[0], indices[-1]) <
+                                     self.shape[0]):
+            raise IndexError('Frames %d to %d out of range for %d frames' %
+                             (indices[0], indices[-1], self.shape[0]))
+        if np.ndim(value) == 0 and value == 0:
+            # Frames not reached yet are zero already, so clearing only
+            # touches the current chunk
+            end = self._chunk_start + self._chunk_frames
+            if indices.step > 0:
+                indices = indices[:len(range(indices.start, end,
+                                             indices.step))]
+            else:
+                indices = indices[len(range(indices.start, end - 1,
+                                            indices.step)):]
+            for idx in indices:
+                self.frame(idx)[rest] = 0
+            return
+        sub_shape = np.empty(self.shape[1:], dtype=np.bool_)[rest].shape
+        value = np.broadcast_to(value, (len(indices),) + sub_shape)
+
+        for i, idx in enumerate(indices):
+            if (idx >= self._chunk_start + self._chunk_frames and
+                    not value[i].any()):
+                continue
+            self.frame(idx)[rest] = value[i]
+
+    def frame(self, idx):
+        if idx < self._chunk_start:
+            raise ValueError('Frames must be written in order, frame %d '
+                             'is already flushed' % idx)
+        while idx >= self._chunk_start + self._chunk_frames:
+            self.flush_chunk()
+        return self._chunk[idx - self._chunk_start]
+
+    def flush_chunk(self):
+        num_frames = min(self._chunk_frames,
+                         self.shape[0] - self._chunk_start)
+        self.emit(self._chunk_start, self._chunk[:num_frames])
+        self._chunk_start += self._chunk_frames
+        self._chunk[:] = 0
+
+    @abc.abstractmethod
+    def emit(self, first, frames):
+        """Handle the chunk of frames starting at first
+
+            frames is reused for the next chunk once this returns.
+        """
+
+    def close(self):
+        """Emit the remaining chunks"""
+        while self._chunk_start < self.shape[0]:
+            self.flush_chunk()
+
+
+class RenderCancelled(Exception):
+    pass
+
+
+class HandoverSink(ChunkedSink):
+    """Hand chunks from the render thread over to a consumer
+
+    The render thread waits once max_chunks chunks are not consumed yet,
+    so that memory stays bounded. Subclasses implement `deliver`, which
+    must not block, and the consumer calls `consumed` for every item.
+
+    Args:
+        shape (Tuple[int]): Shape of the snapshots, frames first.
+        chunk_frames (int): Number of frames in a chunk.
+        max_chunks (int): Number of chunks the render thread may be ahead
+            of the consumer before it waits.
+    """
+
+    def __init__(self, shape, chunk_frames=DEFAULT_CHUNK_FRAMES,
+                 max_chunks=DEFAULT_MAX_CHUNKS):
+        super().__init__(shape, chunk_frames)
+        self._slots = threading.Semaphore(max_chunks)
+        self._cancelled = threading.Event()
+
+    def render(self, processor):
+        """Run a `SnapshotThread` into this sink on the calling thread
+
+            Delivers None once all chunks are delivered, or the error that
+            stopped rendering.
+        """
+        try:
+            processor.run()
+            self.close()
+        except BaseException as e:
+            self.deliver(e)
+        else:
+            self.deliver(None)
+
+    def emit(self, first, frames):
+        self._slots.acquire()
+        if self._cancelled.is_set():
+            raise RenderCancelled()
+        self.deliver((first, frames.copy()))
+
+    @abc.abstractmethod
+    def deliver(self, item):
+        """Pass a (first, frames) chunk, None or an error to the consumer"""
+
+    def consumed(self):
+        self._slots.release()
+
+    def cancel(self):
+        """Stop rendering at the next chunk"""
+        self._cancelled.set()
+        # Unblock the render thread if it waits for a slot
+        self._slots.release()
+
+
+class SnapshotWriter(ChunkedSink):
+    """Write snapshots frame by frame into a chunk-compressed file
+
+    Args:
+        path (str): The file to write.
+        shape (Tuple[int]): Shape of the snapshots, frames first.
+        chunk_frames (int): Number of frames compressed together.
+        codec (str): One of `CODECS`.
+        delta (bool): Encode each frame against the previous one within
+            its chunk.
+    """
+
+    def __init__(self, path, shape, chunk_frames=DEFAULT_CHUNK_FRAMES,
+                 codec='zlib', delta=True):
+        super().__init__(shape, chunk_frames)
+        self._path = path
+        self._codec = codec
+        self._compress, _ = get_codec(codec)
+        self._delta = delta
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._offsets = [self._file.tell()]
+
+    def emit(self, first, frames):
+        self._file.write(self._compress(encode_chunk(frames, self._delta)))
+        self._offsets.append(self._file.tell())
+
+    def close(self):
+        if self._file.closed:
+            return
+        super().close()
+        index = json.dumps({
+            'shape': self.shape,
+            'chunk_frames': self._chunk_frames,
+            'codec': self._codec,
+            'delta': self._delta,
+            'offsets': self._offsets
+        }).encode()
+        self._file.write(index)
+        self._file.write(FOOTER.pack(len(index), MAGIC))
+        self._file.close()
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def abort(self):
+        """Close without finishing the file and remove it"""
+        if self._file.closed:
+            return
+        self._file.close()
+        os.remove(self._path)
+
+
+class SnapshotReader():
+    """Random access to snapshots written by `SnapshotWriter`
+
+    Indexing works like on the array returned by `make_snapshots`, and
+    only the chunks holding the requested frames are decompressed.
+
+    Args:
+        path (str): The file to read.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        if self._file.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a snapshot file' % path)
+        self._file.seek(-FOOTER.size, 2)
+        index_size, magic = FOOTER.unpack(self._file.read(FOOTER.size))
+        if magic != MAGIC:
+            raise ValueError('%s is truncated' % path)
+        self._file.seek(-FOOTER.size - index_size, 2)
+        index = json.loads(self._file.read(index_size).decode())
+
+        self.shape = tuple(index['shape'])
+        self.dtype = np.dtype(np.float32)
+        self._chunk_frames = index['chunk_frames']
+        self._delta = index['delta']
+        self._offsets = index['offsets']
+        _, self._decompress = get_codec(index['codec'])
+        self._cached_idx = None
+        self._cached_chunk = None
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getitem__(self, key):
+        rest = ()
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.shape[0])
+            if step == 1:
+                return self.read(start, max(start, stop))[
+                    (slice(None),) + rest]
+            frames = [self.read(idx, idx + 1)
+                      for idx in range(start, stop, step)]
+            return np.concatenate(
+                frames or [np.empty((0,) + self.shape[1:],
+                                    dtype=np.float32)])[
+                (slice(None),) + rest]
+
+        idx = operator.index(key)
+        if idx < 0:
+            idx += self.shape[0]
+        if not 0 <= idx < self.shape[0]:
+            raise IndexError('Frame %d out of range for %d frames' %
+                             (key, self.shape[0]))
+        return self.read(idx, idx + 1)[0][rest]
+
+    def read(self, first, last):
+        """Read the frames in [first, last)
+
+            Returns:
+                A numpy array of size (last - first) x shape[1:]
+        """
+        result = np.empty((last - first,) + self.shape[1:],
+                          dtype=np.float32)
+        for chunk_idx in range(first // self._chunk_frames,
+                               -(-last // self._chunk_frames)):
+            chunk_start = chunk_idx * self._chunk_frames
+            chunk = self.read_chunk(chunk_idx)
+            lo = max(first, chunk_start)
+            hi = min(last, chunk_start + chunk.shape[0])
+            result[lo - first:hi - first] = \
+                chunk[lo - chunk_start:hi - chunk_start]
+        return result
+
+    def read_chunk(self, chunk_idx):
+        if chunk_idx != self._cached_idx:
+            self._file.seek(self._offsets[chunk_idx])
+            data = self._decompress(self._file.read(
+                self._offsets[chunk_idx + 1] - self._offsets[chunk_idx]))
+            num_frames = min(self._chunk_frames,
+                             self.shape[0] - chunk_idx * self._chunk_frames)
+            self._cached_chunk = decode_chunk(
+                data, (num_frames,) + self.shape[1:], self._delta)
+            self._cached_idx = chunk_idx
+        return self._cached_chunk
+
+    def close(self):
+        self._file.close()
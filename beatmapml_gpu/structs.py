@@ -2,3 +2,6 @@ from collections import namedtuple
 
 Rect = namedtuple('Rect', ['left', 'top', 'right', 'bottom'])
 Dimension = namedtuple('Rect', ['w', 'h'])
+SnapshotEstimate = namedtuple('SnapshotEstimate',
+                              ['shape', 'nbytes', 'nonempty_frames',
+                               'slider_vertices', 'peak_objects'])
@@ -0,0 +1,196 @@
+from slider import Beatmap
+from numbers import Rational
+from typing import Iterator, Optional, Tuple, Union
+import numpy as np
+import queue
+import threading
+
+from .gl_backend import DEFAULT_FRAMES_IN_FLIGHT
+from .snapshot import SnapshotThread
+from .storage import DEFAULT_CHUNK_FRAMES, HandoverSink
+
+__all__ = [
+    'iter_snapshot_windows',
+    'make_snapshot_windows',
+    'sliding_windows'
+]
+
+
+def sliding_windows(frames: np.ndarray, length: int,
+                    stride: int = 1) -> np.ndarray:
+    """View consecutive frames as overlapping windows without copying
+
+        Args:
+            frames (np.ndarray): Snapshots, frames first.
+            length (int): Number of frames in a window.
+            stride (int): Number of frames between starts of windows.
+
+        Returns:
+            A read-only view of size num_windows x length x frames.shape[1:],
+            where window i is frames[i * stride:i * stride + length].
+    """
+    if length < 1 or stride < 1:
+        raise ValueError('Window length and stride must be positive')
+    num_windows = max(0, (frames.shape[0] - length) // stride + 1)
+    return np.lib.stride_tricks.as_strided(
+        frames,
+        shape=(num_windows, length) + frames.shape[1:],
+        strides=(frames.strides[0] * stride,) + frames.strides,
+        writeable=False)
+
+
+def make_snapshot_windows(beatmap: Beatmap,
+                          target_width: int,
+                          capture_rate: Union[int, Rational],
+                          length: int,
+                          stride: int = 1,
+                          pad_start: int = 0,
+                          pad_end: int = 0,
+                          device: Optional[int] = None,
+                          curve_quality: float = 1.0,
+                          multichannel: bool = False,
+                          max_tile_size: Optional[int] = None,
+                          frames_in_flight: int = DEFAULT_FRAMES_IN_FLIGHT
+                          ) -> np.ndarray:
+    """Make snapshots of a beatmap as windows of consecutive frames
+    Args:
+        beatmap (Beatmap): The beatmap to process.
+        target_width (int): The pixel width of desired output.
+        capture_rate (int or Fraction): The capture rate of the snapshots
+            in Hz.
+        length (int): Number of frames in a window.
+        stride (int): Number of frames between starts of windows.
+        pad_start (int): Number of empty frames before the first snapshot,
+            e.g. length - 1 for a window ending at every snapshot.
+        pad_end (int): Number of empty frames after the last snapshot.
+        device (int): Index of the EGL device to render on. Defaults to
+            the default display.
+        curve_quality (float): Density of slider tessellation relative to
+            the output resolution, see `calc_tolerance`.
+        multichannel (bool): Write separate channels, see `make_snapshots`.
+        max_tile_size (int): Largest framebuffer side in pixels, see
+            `make_snapshots`.
+        frames_in_flight (int): Number of snapshots queued on the GPU
+            before the oldest is read back, see `make_snapshots`.
+    Returns:
+        A view as returned by `sliding_windows` over the padded snapshots,
+        which are rendered once and never copied into windows.
+    """
+    shape = SnapshotThread.buffer_shape(beatmap, target_width, capture_rate,
+                                        multichannel=multichannel)
+    frames = np.zeros((pad_start + shape[0] + pad_end,) + shape[1:],
+                      dtype=np.float32)
+    processor = SnapshotThread(beatmap, target_width, capture_rate,
+                               frames[pad_start:pad_start + shape[0]],
+                               device=device, curve_quality=curve_quality,
+                               multichannel=multichannel,
+                               max_tile_size=max_tile_size,
+                               frames_in_flight=frames_in_flight)
+    # Render on this thread, so that errors reach the caller
+    processor.run()
+    return sliding_windows(frames, length, stride)
+
+
+def iter_snapshot_windows(beatmap: Beatmap,
+                          target_width: int,
+                          capture_rate: Union[int, Rational],
+                          length: int,
+                          stride: int = 1,
+                          pad_start: int = 0,
+                          pad_end: int = 0,
+                          device: Optional[int] = None,
+                          curve_quality: float = 1.0,
+                          multichannel: bool = False,
+                          max_tile_size: Optional[int] = None,
+                          frames_in_flight: int = DEFAULT_FRAMES_IN_FLIGHT,
+                          chunk_frames: int = DEFAULT_CHUNK_FRAMES) \
+        -> Iterator[Tuple[int, np.ndarray]]:
+    """Make windows of snapshots while the snapshots are rendered
+    Args:
+        beatmap (Beatmap): The beatmap to process.
+        target_width (int): The pixel width of desired output.
+        capture_rate (int or Fraction): The capture rate of the snapshots
+            in Hz.
+        length (int): Number of frames in a window.
+        stride (int): Number of frames between starts of windows.
+        pad_start (int): Number of empty frames before the first snapshot.
+        pad_end (int): Number of empty frames after the last snapshot.
+        device (int): Index of the EGL device to render on. Defaults to
+            the default display.
+        curve_quality (float): Density of slider tessellation relative to
+            the output resolution, see `calc_tolerance`.
+        multichannel (bool): Write separate channels, see `make_snapshots`.
+        max_tile_size (int): Largest framebuffer side in pixels, see
+            `make_snapshots`.
+        frames_in_flight (int): Number of snapshots queued on the GPU
+            before the oldest is read back, see `make_snapshots`.
+        chunk_frames (int): Number of frames handed over from the render
+            thread at once.
+    Yields:
+        Tuples of the index of the first snapshot in a window, negative
+        within pad_start, and the window of size length x frame shape.
+        The same windows as `make_snapshot_windows` are yielded, but a
+        window is only valid until the next one is requested, as memory
+        for 2 x length frames is reused throughout.
+    """
+    if length < 1 or stride < 1:
+        raise ValueError('Window length and stride must be positive')
+    shape = SnapshotThread.buffer_shape(beatmap, target_width, capture_rate,
+                                        multichannel=multichannel)
+    sink = QueueSink(shape, chunk_frames)
+    processor = SnapshotThread(beatmap, target_width, capture_rate, sink,
+                               device=device, curve_quality=curve_quality,
+                               multichannel=multichannel,
+                               max_tile_size=max_tile_size,
+                               frames_in_flight=frames_in_flight)
+    thread = threading.Thread(target=sink.render, args=(processor,),
+                              daemon=True)
+    thread.start()
+
+    # Every frame is written twice, so that the latest length frames are
+    # always a contiguous slice of the ring
+    ring = np.zeros((2 * length,) + shape[1:], dtype=np.float32)
+    empty = np.zeros(shape[1:], dtype=np.float32)
+
+    def frames():
+        for _ in range(pad_start):
+            yield empty
+        while True:
+            item = sink.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            _, chunk = item
+            yield from chunk
+        for _ in range(pad_end):
+            yield empty
+
+    try:
+        for frame_idx, frame in enumerate(frames()):
+            pos = frame_idx % length
+            ring[pos] = frame
+            ring[pos + length] = frame
+            first = frame_idx + 1 - length
+            if first >= 0 and first % stride == 0:
+                yield (first - pad_start,
+                       ring[(pos + 1) % length:(pos + 1) % length + length])
+    finally:
+        sink.cancel()
+        thread.join()
+
+
+class QueueSink(HandoverSink):
+    """Hand chunks from the render thread over to a consumer thread"""
+
+    def __init__(self, shape, chunk_frames):
+        super().__init__(shape, chunk_frames)
+        self._chunks = queue.Queue()
+
+    def deliver(self, item):
+        self._chunks.put(item)
+
+    def get(self):
+        item = self._chunks.get()
+        self.consumed()
+        return item
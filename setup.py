@@ -27,5 +27,13 @@ setup(
         'pyopengl_accelerate',
         ('slider @ git+https://github.com/llllllllll/slider.git@'
          'master#egg=slider-0.1.0')
-    ]
+    ],
+    extras_require={
+        'zstd': ['zstandard']
+    },
+    entry_points={
+        'console_scripts': [
+            'beatmapml_gpu_daemon=beatmapml_gpu.daemon:main'
+        ]
+    }
 )